@@ -17,17 +17,103 @@ right: go right then go as left as possible - closest higher.
 parent: can only follow parent up (one child is where you came from,
 other child is further away) - could be either.
 """
+import math
+from collections import deque
 from bst import BST
+import statistics as stats
 
-def avgs(times: list, k: int=5) -> list:
-    """ Finds the rolling aok averages for a given list. """
-    blocks = stats.block(times, k, roll=True)
+# every float is an integer multiple of 2^-1074
+SCALE = 1 << 1074
 
-if __name__ == "__main__":
-    import statistics as stats
+class Cutoff:
+    """ Running sum of every time at or below a pointer into the tree.
+        Sums are kept exact (as integer multiples of the smallest float) so that
+        they never drift over a long session, DNFs are counted separately. """
+
+    def __init__(self, tree: BST, keys: list, j: int):
+        self.tree, self.key = tree, keys[j - 1] if j > 0 else None
+        self.total, self.dnfs = 0, 0
+        for key in keys[:j]:
+            self.shift(key[0], 1)
+
+    def shift(self, t: float, sign: int) -> None:
+        """ Adds (or removes) a time from the sum. """
+        if t == stats.DNF:
+            self.dnfs += sign
+        else:
+            p, q = t.as_integer_ratio()
+            self.total += sign*p*(SCALE//q)
+
+    def add(self, key: tuple) -> None:
+        """ A new time was added to the tree, pointer moves closer to the lower side. """
+        if self.key is not None and key < self.key:
+            self.shift(key[0], 1)
+            self.shift(self.key[0], -1)
+            self.key = self.tree.lower(self.key).key
+
+    def delete(self, key: tuple) -> None:
+        """ A time is about to be removed from the tree, pointer moves closer to the upper side. """
+        if self.key is not None and key <= self.key:
+            self.shift(key[0], -1)
+            self.key = self.tree.higher(self.key).key
+            self.shift(self.key[0], 1)
+
+class Window:
+    """ Rolling aoK (or moK when nothing is trimmed), one time at a time. """
+
+    def __init__(self, k: int=5, trim: float=0.05):
+        self.k, self.trim = k, trim
+        self.drop = math.ceil(trim*k)
+        self.n = k - 2*self.drop
+        self.keys, self.i = deque(), 0
+        self.tree = self.lower = self.upper = None
 
+    def push(self, t: float) -> float:
+        """ Adds a time, returning the current average once the window is full. """
+        # ties are broken by index, which keeps every key in the tree distinct
+        new = (t, self.i)
+        self.keys.append(new)
+        self.i += 1
+        if self.tree is None:
+            if len(self.keys) < self.k:
+                return None
+            keys = sorted(self.keys)
+            self.tree = BST.from_sorted(keys)
+            self.lower, self.upper = Cutoff(self.tree, keys, self.drop), Cutoff(self.tree, keys, self.k - self.drop)
+            return self.avg()
+
+        old = self.keys.popleft()
+        self.tree.add(new)
+        self.lower.add(new), self.upper.add(new)
+        self.lower.delete(old), self.upper.delete(old)
+        self.tree.delete(old)
+        return self.avg()
+
+    def avg(self) -> float:
+        """ The average of the current window, rounded like stats.mean. """
+        if self.upper.dnfs > 0:
+            return round(stats.DNF/self.n, 2)
+        total, den = self.upper.total - self.lower.total, SCALE*self.n
+        avg = total/den
+        # on (or within rounding error of) a tie, mean's own float sum decides
+        if abs(2*(100*total % den) - den)/den < 1e-6*(1 + abs(avg)):
+            times = [key[0] for key in self.keys]
+            return stats.mean(times if self.drop == 0 else sorted(times)[self.drop:-self.drop])
+        return round(avg, 2)
+
+def avgs(times: list, k: int=5, trim: float=0.05) -> list:
+    """ Finds the rolling aok averages for a given list.
+        Equivalent to list(map(lambda l: stats.ao(l, trim), stats.block(times, k, roll=True))). """
+    k = len(times[:k])
+    drop = math.ceil(trim*k)
+    # same slice as ao, so an empty average fails the same way
+    if len(range(k)[drop:-drop]) == 0:
+        raise ZeroDivisionError("division by zero")
+    window = Window(k, trim)
+    return [avg for avg in map(window.push, times) if avg is not None]
+
+if __name__ == "__main__":
     times = [9.58, 10.23, 23.42, 5.63, 42.53, 10.34, 11.58, 12.47]
     stats_avgs = list(map(stats.ao, stats.block(times, roll=True)))
     print(stats_avgs)
     print(avgs(times))
-
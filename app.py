@@ -15,7 +15,7 @@ from fido2.ctap2 import AttestationObject, AuthenticatorData
 from fido2 import cbor
 from fido2.utils import websafe_encode, websafe_decode
 from fido2.ctap2 import AttestedCredentialData
-import cube, forms, statistics
+import cube, forms, statistics, visits, jobs, cache
 
 # TODO: general security, enable autoescaping
 # print([rule.endpoint for rule in app.url_map.iter_rules()])
@@ -65,30 +65,12 @@ def alert(msg: str, category: str="success", loc: str="index") -> Response:
 @app.before_request
 def before_request() -> None:
     """ Runs before each request. """
-    try:
-        vote = cube.load_file("vote")
-    except:
-        #sometimes fails, not sure why
-        app.logger.warning("Error in parsing JSON file")
-    else:
-        if time.time() > cube.short_date(vote["ends_at"]):
-            vote["vote_active"] = False
-            cube.dump_file(vote, "vote")
-
     # record number of times each page has been visted
     path = flask.request.path
     if path.split("/")[1] != "static" and path.split("/")[1] != "_uploads":
-        vists = cube.load_file("vists")
-        date = cube.unix_to_date(time.time())
-        vists[path] = vists.get(path, {})
-        vists[path][date] = vists[path].get(date, 0) + 1
-
-        # more than one day
-        if time.time() - vists["time"] > 60*60*24:
-            cube.graph_vists()
-            vists["time"] = time.time()
-
-        cube.dump_file(vists, "vists")
+        # once a day is over
+        if visits.count(path):
+            jobs.submit("graph_vists")
 
 # @app.after_request
 # def do_something_whenever_a_request_has_been_handled(response):
@@ -131,7 +113,7 @@ def in_house() -> dict:
 
 def result() -> dict:
     """ Displays the result of the election. """
-    return {"result": cube.get_winner(), "vote": cube.load_file("vote")}
+    return {"result": cube.get_winner(), "vote": cube.get_vote()}
 
 # http://flask.pocoo.org/docs/1.0/patterns/fileuploads/
 def stats() -> dict:
@@ -140,15 +122,19 @@ def stats() -> dict:
     rtn = {"form": form, "file": file}
 
     if form.validate_on_submit():
-        times = statistics.parse_text(form.times.data)
+        times = statistics.parse_stream(form.times.data)
     elif file.validate_on_submit():
-        times = statistics.parse(file.file.data)
+        times = statistics.parse_stream(file.file.data)
     else:
-        times = None
+        return rtn
 
-    if times:
-        descr, mean, best = statistics.process(times)
-        return cube.add_dict({"descr": descr, "mean": mean, "best": best}, rtn)
+    # times are read straight from the upload as the report consumes them
+    report = statistics.report(times)
+    if report["count"] > 0:
+        rtn = cube.add_dict({"report": report}, rtn)
+    if report["blocks"] is not None:
+        descr, mean, best = report["blocks"]
+        rtn = cube.add_dict({"descr": descr, "mean": mean, "best": best}, rtn)
 
     return rtn
 
@@ -165,8 +151,6 @@ def profile() -> dict:
            "httpForm": httpForm, "ionForm": ionForm, "wcaForm": wcaForm
           }
 
-    users = cube.load_file("users")
-
     if "account" in flask.session:
         tabs = [["overview", "API"], ["email", "refresh", "develop"], ["edit"]]
         scopes = {"default": 0, "privileged": 1, "admin": 2}
@@ -194,7 +178,7 @@ def profile() -> dict:
     if scope >= 0:
         if "confirm" in flask.request.form and signupForm.validate_on_submit():
             username, password = signupForm.username.data, signupForm.password.data
-            if username in cube.load_file("users"):
+            if cube.get_user(username) is not None:
                 return alert("Username is taken.", "info", "meta")
             if password != signupForm.confirm.data:
                 return alert("Passwords do not match.", "info", "meta")
@@ -208,17 +192,18 @@ def profile() -> dict:
                 return alert("Username or password is incorrect.", "info", "self")
 
             # Save login to cookies if 2fa is not enabled, otherwise don't
-            if "2fa" not in users[username] and "yubi" not in users[username]:
+            user = cube.get_user(username)
+            if "2fa" not in user and "yubi" not in user:
                 flask.session["account"] = username
-                flask.session["scope"] = users[username]["scope"]
+                flask.session["scope"] = user["scope"]
             else:
-                if "2fa" in users[username]:
+                if "2fa" in user:
                     flask.session["2fa"] = True
                 flask.session["username"] = username
 
             # load U2F challenge if it exists
-            if "yubi" in users[username]:
-                flask.session["yubi"] = websafe_decode(users[username]["yubi"])
+            if "yubi" in user:
+                flask.session["yubi"] = websafe_decode(user["yubi"])
 
             return flask.redirect(flask.url_for("profile"))
 
@@ -233,7 +218,7 @@ def profile() -> dict:
 
             # actually login
             flask.session["account"] = username
-            flask.session["scope"] = users[username]["scope"]
+            flask.session["scope"] = cube.get_user(username)["scope"]
             return flask.redirect(flask.url_for("profile"))
 
         elif "cancel_2fa" in flask.request.form and "2fa" in flask.session:
@@ -280,9 +265,9 @@ If you're tired of seeing these emails, unsubscribe [here]({cube.TJ}).
                 del flask.session["yubi"]
 
         if "delete" in flask.request.form:
-            del users[flask.session["account"]]
+            with cube.update_file("users") as users:
+                del users[flask.session["account"]]
             del flask.session["account"]
-            cube.dump_file(users, "users")
             return alert("Account deleted!", "success", "self")
 
         if "clear" in flask.request.form:
@@ -305,60 +290,59 @@ If you're tired of seeing these emails, unsubscribe [here]({cube.TJ}).
 
         if "history" in flask.request.form:
             cube.save_club_history()
-            cube.graph_capacity()
-            cube.graph_blocks("by_x")
-            cube.graph_blocks("by_y")
-            alert("Updated the club history!")
+            jobs.submit("graph_capacity")
+            jobs.submit("graph_blocks", "by_x")
+            jobs.submit("graph_blocks", "by_y")
+            alert("Updated the club history! The graphs are being redrawn.")
 
         if "heatmap" in flask.request.form:
-            cube.graph_vists()
-            alert("Updated the heatmap!")
+            jobs.submit("graph_vists")
+            alert("The heatmap is being redrawn!")
 
     return rtn
 
 def delete_photo() -> None:
     """ Deletes a photo from the server. """
-    users = cube.load_file("users")
-    user = users[flask.session["account"]]
-    try:
-        del user["pfp"]
-    except KeyError:
-        pass
-
-    try:
-        os.remove(forms.photos.path(user["pfpfilename"]))
-        del user["pfpfilename"]
-    except (KeyError, FileNotFoundError):
-        pass
+    with cube.update_file("users") as users:
+        user = users[flask.session["account"]]
+        try:
+            del user["pfp"]
+        except KeyError:
+            pass
 
-    cube.dump_file(users, "users")
+        try:
+            os.remove(forms.photos.path(user["pfpfilename"]))
+            del user["pfpfilename"]
+        except (KeyError, FileNotFoundError):
+            pass
 
 def settings() -> dict:
     """ Adjusts a user's profile. """
     if "account" not in flask.session:
         return flask.redirect("profile")
 
-    users = cube.load_file("users")
-    user = users[flask.session["account"]]
+    account = flask.session["account"]
     gpgForm = forms.GPGForm()
     photoForm = forms.PhotoForm()
     secret = ""
 
     if gpgForm.validate_on_submit():
+        # gpg runs outside the lock
         key = cube.gpg.import_keys(gpgForm.gpgkey.data)
-        user["keys"] += cube.gpg.list_keys(keys=[key.fingerprints[0]])
-        curr = user["keys"][-1]
-        curr["fuids"] = ", ".join([uid.split()[-1][1:-1] for uid in curr["uids"]])
-        cube.dump_file(users, "users")
+        keys = cube.gpg.list_keys(keys=[key.fingerprints[0]])
+        with cube.update_file("users") as users:
+            user = users[account]
+            user["keys"] += keys
+            curr = user["keys"][-1]
+            curr["fuids"] = ", ".join([uid.split()[-1][1:-1] for uid in curr["uids"]])
         return alert("GPG key added.", "success", "meta")
 
     elif photoForm.validate_on_submit():
-        users = cube.load_file("users")
         delete_photo() #old profile picture not necessary anymore
         filename = forms.photos.save(photoForm.photo.data)
-        users[flask.session["account"]]["pfp"] = forms.photos.url(filename)
-        users[flask.session["account"]]["pfpfilename"] = filename
-        cube.dump_file(users, "users")
+        with cube.update_file("users") as users:
+            users[account]["pfp"] = forms.photos.url(filename)
+            users[account]["pfpfilename"] = filename
         return alert("Profile photo changed.", "success", "profile")
 
     if flask.request.method == "POST":
@@ -366,22 +350,21 @@ def settings() -> dict:
             delete_photo()
             return alert("Profile picture removed.", "success", "profile")
 
-        if "delete" in flask.request.form:
-            del user["keys"][int(flask.request.form["delete"])]
-            cube.dump_file(users, "users")
+        if any(field in flask.request.form for field in ["delete", "enable_2fa", "disable_2fa", "disable_yubi"]):
+            with cube.update_file("users") as users:
+                user = users[account]
+                if "delete" in flask.request.form:
+                    del user["keys"][int(flask.request.form["delete"])]
 
-        if "enable_2fa" in flask.request.form:
-            secret = cube.pyotp.random_base32()
-            user["2fa"] = secret
-            cube.dump_file(users, "users")
+                if "enable_2fa" in flask.request.form:
+                    secret = cube.pyotp.random_base32()
+                    user["2fa"] = secret
 
-        if "disable_2fa" in flask.request.form:
-            del user["2fa"]
-            cube.dump_file(users, "users")
+                if "disable_2fa" in flask.request.form:
+                    del user["2fa"]
 
-        if "disable_yubi" in flask.request.form:
-            del user["yubi"]
-            cube.dump_file(users, "users")
+                if "disable_yubi" in flask.request.form:
+                    del user["yubi"]
 
     return {"gpgForm": gpgForm, "photoForm": photoForm, "secret": secret}
 
@@ -394,18 +377,23 @@ def records() -> dict:
         me = cube.api_call("wca", "me")["me"]
         year = cube.api_call("ion", "profile")["graduation_year"]
 
-        if [me["url"], me["name"], year] not in people:
-            records["people"].append([me["url"], me["name"], year])
+        person = [me["url"], me["name"], year]
+        if person not in people:
+            with cube.update_file("records") as records:
+                if person not in records["people"]:
+                    records["people"].append(person)
             # New person added
             refresh = True
-            cube.dump_file(records, "records")
 
     if refresh or time.time() - records["time"] > cube.CONFIG["time"]:
         cube.update_records()
-        (sing_rank, avg_rank), kinch_rank = cube.get_ranks()
-        cube.dump_file({"sor_single": sing_rank,
-                        "sor_average": avg_rank,
-                        "kinch": kinch_rank}, "wca/ranks")
+        ranks = cube.get_ranks()
+        # keep the last ranks until the WCA export is ingested
+        if ranks is not None:
+            (sing_rank, avg_rank), kinch_rank = ranks
+            cube.dump_file({"sor_single": sing_rank,
+                            "sor_average": avg_rank,
+                            "kinch": kinch_rank}, "wca/ranks")
 
     return {"times": times, "events": cube.EVENTS, "icons": cube.ICONS, "DNF": statistics.DNF, "ranks": cube.RANKS}
 
@@ -416,11 +404,14 @@ def rankings() -> dict:
 def wca_stats() -> dict:
     """ Computes WCA summary statistics for TJ. """
     ranks = cube.load_file("wca/ranks")
+    sor, kinch = cube.get_metrics()
     return {"events": [cube.ICONS[event][6:] for event in cube.EVENTS],
-            "sor": cube.get_sor(),
+            "sor": sor,
             "sor_rank": (ranks["sor_single"], ranks["sor_average"]),
-            "kinch": cube.get_kinch(),
-            "kinch_rank": ranks["kinch"]
+            "kinch": kinch,
+            "kinch_rank": ranks["kinch"],
+            "country": cube.COUNTRY,
+            "peers": cube.get_peers()
            }
 
 def search() -> dict:
@@ -469,7 +460,7 @@ PAGES = {"": (index, ["POST", "GET"]),
              },
          "vote":
              {
-                "eligibility": lambda: cube.load_file("vote"),
+                "eligibility": cube.get_vote,
                 "admission": lambda: {"admission": cube.open_admission(), "sigs": cube.get_sigs()},
                 "result": result,
              },
@@ -488,6 +479,18 @@ PAGES = {"": (index, ["POST", "GET"]),
          "search": (search, ["POST", "GET"])
         }
 
+# pages which look the same to every visitor who isn't signed in: seconds they're kept, and the tags they're made from
+CACHED = {"algorithms": (60*60, []),
+          "weekly/lectures": (60*60, []),
+          "contact": (60*60, ["fb"]),
+          "archive/emails": (60*60, ["mails"]),
+          "archive/tips": (60*60, []),
+          "archive/media": (60*60, []),
+          "vote/eligibility": (60*60, ["vote"]),
+          "vote/admission": (60*60, []),
+          "results/rankings": (60*60, ["records"]),
+         }
+
 ### Jinja ###
 
 @app.template_filter()
@@ -534,8 +537,8 @@ expose(GLOBAL, [furl, furl_for])
 @app.context_processor
 def GLOBALS() -> dict:
     """ Returns all the global variables passed to every template. """
-    user = cube.load_file("users").get(flask.session.get("account", None), {})
-    vars = {"vote_active": cube.load_file("vote")["vote_active"],
+    user = cube.get_user(flask.session.get("account", None), default={})
+    vars = {"vote_active": cube.get_vote()["vote_active"],
             "user": user,
             "btnform": forms.FlaskForm(),
             "searchForm": forms.SearchForm(),
@@ -554,6 +557,9 @@ def make_page(s: str, f=lambda: {}, methods=['GET']):
         return val
     # Need distinct function names for Flask not to error
     func.__name__ = title if s != "" else "index"
+    if s in CACHED:
+        # the header greys out voting once the vote is over
+        func = cache.page(*CACHED[s], vary=lambda: (cube.get_vote()["vote_active"],))(func)
     return app.route(("/{}" + TSLASH).format(s), methods=methods)(func)
 
 def make_pages(d: dict, prefix="") -> None:
@@ -581,9 +587,8 @@ def static_from_root() -> flask.wrappers.Response:
 def cookie() -> dict:
     """ Returns the user's cookies. """
     data = dict(flask.session)
-    users = cube.load_file("users")
     if "account" in flask.session:
-        user = users[flask.session["account"]]
+        user = cube.get_user(flask.session["account"])
         if len(user["keys"]) > 0:
             return str(cube.gpg.encrypt(flask.json.dumps(data), [k["fingerprint"] for k in user["keys"]], always_trust=True))
     return data
@@ -591,24 +596,22 @@ def cookie() -> dict:
 @app.route("/email")
 def email() -> Response:
     """ After requesting to be added to the email list, see if nonce matches. """
-    emails = cube.load_file("emails")
-    requests = emails["requests"]
     nonce = flask.request.args.get("nonce", None)
+    kind = email = None
+    with cube.update_file("emails") as emails:
+        for key in ["requests", "unsubscribe-requests"]:
+            requests = emails[key]
+            if nonce in requests:
+                kind, email = key, requests[nonce]
+                # Remove previous attempts
+                emails[key] = {nonce: value for nonce, value in requests.items() if value != email}
+                break
     # subscribing
-    if nonce in requests:
-        email = requests[nonce]
-        # Remove previous attempts
-        emails["requests"] = {nonce: value for nonce, value in requests.items() if value != email}
-        cube.dump_file(emails, "emails")
+    if kind == "requests":
         cube.register_email(email)
         return alert("You have been added to the email list.", "success")
-    requests = emails["unsubscribe-requests"]
     # unsubscribing
-    if nonce in requests:
-        email = requests[nonce]
-        # Remove previous attempts
-        emails["unsubscribe-requests"] = {nonce: value for nonce, value in requests.items() if value != email}
-        cube.dump_file(emails, "emails")
+    if kind == "unsubscribe-requests":
         cube.remove_email(email)
         return alert("You have been removed from the email list.", "success")
 
@@ -666,7 +669,7 @@ def vote_requirements():
         flask.session["action"] = flask.request.path
         return flask.redirect(flask.url_for("ion_login"))
 
-    vote = cube.load_file("vote")
+    vote = cube.get_vote()
 
     if not cube.valid_voter():
         return alert("You do not fullfill the requirements to be able to vote.", "warning")
@@ -723,14 +726,10 @@ def check(club_id):
 
     club_name = cube.api_call("ion", f"activities/{club_id}")["name"]
     fname = f"signups_{club_id}"
-    record = cube.load_file(fname)
-
     username = cube.api_call("ion", "profile")["ion_username"]
     signups = cube.get_signups(club_id)
     number = cube.count_meetings(signups)
-    record[username] = number
-
-    cube.dump_file(record, fname)
+    cube.dump_entry(number, fname, username)
 
     return alert(f"Recorded for {username} {number} attendances at {club_name}")
 
@@ -772,9 +771,7 @@ def register_complete():
 
     flask.session["credentials"].append(auth_data.credential_data)
     encoded = websafe_encode(auth_data.credential_data)
-    users = cube.load_file("users")
-    users[flask.session["account"]]["yubi"] = encoded
-    cube.dump_file(users, "users")
+    cube.dump_entry(encoded, "users", flask.session["account"], "yubi")
 
     # print("REGISTERED CREDENTIAL:", auth_data.credential_data)
     return cbor.encode({"status": "OK"})
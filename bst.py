@@ -1,109 +1,247 @@
 # Balanced binary search tree (AVL tree) implementation
+# Everything is iterative so depth is never bounded by Python's recursion limit.
+# Equal keys are allowed: a new key goes after every key equal to it.
 
 class Node:
 
-    def __init__(self, key, value=None, parent=None, left=None, right=None):
+    # no per-node __dict__ or child list, a node is a single small object
+    __slots__ = ("key", "value", "parent", "left", "right", "height", "size", "total")
+
+    def __init__(self, key, value=None, parent=None, total=0):
         self.key, self.value, self.parent = key, value, parent
-        self.child = [left, right]
-        self.balance, self.height = 0, 1
+        self.left = self.right = None
+        self.height = 1
+        # order statistics: number of nodes and sum of weights in the subtree
+        self.size, self.total = 1, total
 
     def __str__(self) -> str:
         return f"{self.key}:{self.value}:{self.balance}" if self.value is not None else str(self.key)
 
-    def extrema(self, i: int):
+    @property
+    def balance(self) -> int:
+        return height(self.right) - height(self.left)
+
+    def min(self):
+        n = self
+        while n.left is not None:
+            n = n.left
+        return n
+
+    def max(self):
         n = self
-        while n.child[i] is not None:
-            n = n.child[i]
+        while n.right is not None:
+            n = n.right
         return n
 
-    def min(self): return self.extrema(0)
+    def next(self):
+        """ Returns the in-order successor. """
+        if self.right is not None:
+            return self.right.min()
+        n = self
+        while n.parent is not None and n.parent.right is n:
+            n = n.parent
+        return n.parent
+
+def height(n) -> int: return n.height if n is not None else 0
 
-    def max(self): return self.extrema(1)
+def size(n) -> int: return n.size if n is not None else 0
 
 class BST:
 
-    def __init__(self):
+    def __init__(self, weight=None):
         self.root = None
+        # what prefix_sum adds up for each key, nothing is added up without one
+        self.weight = weight
+
+    def weigh(self, key):
+        return self.weight(key) if self.weight is not None else 0
+
+    @classmethod
+    def from_sorted(cls, keys, values=None, weight=None):
+        """ Builds a perfectly balanced tree from sorted keys in O(n). """
+        tree = cls(weight)
+        keys = list(keys)
+        values = list(values) if values is not None else [None]*len(keys)
+        nodes = [Node(key, value, None, tree.weigh(key)) for key, value in zip(keys, values)]
+        # the middle of each range is the root of its subtree
+        order, stack = [], [(0, len(nodes), None, None)]
+        while stack:
+            lo, hi, p, left = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi)//2
+            n = nodes[mid]
+            n.parent = p
+            if p is None:
+                tree.root = n
+            elif left:
+                p.left = n
+            else:
+                p.right = n
+            order.append(n)
+            stack.append((lo, mid, n, True))
+            stack.append((mid + 1, hi, n, False))
+        # parents come before their children in order
+        for n in reversed(order):
+            tree.update_height(n)
+        return tree
+
+    def merge(self, other):
+        """ Returns a new tree with the keys of both trees in O(n + m). """
+        a, b = iter(self), iter(other)
+        x, y = next(a, None), next(b, None)
+        nodes = []
+        while x is not None or y is not None:
+            if y is None or (x is not None and not y.key < x.key):
+                nodes.append(x)
+                x = next(a, None)
+            else:
+                nodes.append(y)
+                y = next(b, None)
+        return BST.from_sorted([n.key for n in nodes], [n.value for n in nodes], self.weight)
 
-    def __str__(self, n=None, s="", d=0) -> str:
-        if d == 0: n = self.root
-        if n is None: return s
-        s = self.__str__(n.child[0], s, d + 1)
-        s += " "*4*d + str(n) + "\n"
-        s = self.__str__(n.child[1], s, d + 1)
+    def split(self, key) -> tuple:
+        """ Returns two new trees, one with the keys less than key and the other with the rest, in O(n). """
+        nodes = list(self)
+        i = self.rank(key)
+        return tuple(BST.from_sorted([n.key for n in part], [n.value for n in part], self.weight)
+                     for part in (nodes[:i], nodes[i:]))
+
+    def __str__(self) -> str:
+        s, stack, n, d = "", [], self.root, 0
+        while stack or n is not None:
+            if n is not None:
+                stack.append((n, d))
+                n, d = n.left, d + 1
+            else:
+                n, d = stack.pop()
+                s += " "*4*d + str(n) + "\n"
+                n, d = n.right, d + 1
         return s
 
+    def __len__(self) -> int:
+        return size(self.root)
+
+    def __iter__(self):
+        """ Yields the nodes in order. """
+        n = self.root.min() if self.root is not None else None
+        while n is not None:
+            yield n
+            n = n.next()
+
     def min(self): return self.root.min()
 
     def max(self): return self.root.max()
 
-    def __add(self, key, value, n):
-        if n.child[key > n.key] is None:
-            n.child[key > n.key] = Node(key, value, n)
-            return
-        self.__add(key, value, n.child[key > n.key])
-
     def add(self, key, value=None):
-        if self.root is None:
-            self.root = Node(key, value)
-            return
-        self.__add(key, value, self.root)
-
-        n = self.find(key, value)
-        self.trace_heights(n)
-        self.trace(n)
-
-    def __find(self, key, value, n):
-        if key == n.key and value == n.value:
+        n, p = self.root, None
+        while n is not None:
+            p, n = n, n.left if key < n.key else n.right
+        n = Node(key, value, p, self.weigh(key))
+        if p is None:
+            self.root = n
             return n
-
-        if n.child[key > n.key] is None:
-            return None
-
-        return self.__find(key, value, n.child[key > n.key])
+        if key < p.key:
+            p.left = n
+        else:
+            p.right = n
+        self.retrace(p)
+        return n
 
     def find(self, key, value=None):
-        return self.__find(key, value, self.root)
+        """ Returns the first node with the given key and value, None if not found. """
+        # leftmost node with the key, then walk through its duplicates
+        n, first = self.root, None
+        while n is not None:
+            if n.key < key:
+                n = n.right
+            else:
+                if n.key == key:
+                    first = n
+                n = n.left
+        while first is not None and first.key == key:
+            if first.value == value:
+                return first
+            first = first.next()
+        return None
 
     def contains(self, key, value=None) -> bool:
         return self.find(key, value) is not None
 
-    def delete(self, key, value=None):
-        n = self.find(key, value)
-        # leaf node
-        if n.child[0] is None and n.child[1] is None:
-            # root node
-            if n.parent is None:
-                self.root = None
-                return
-            self.set_children(n.parent, n.key, None)
-            to_trace = n.parent
-        elif n.child[0] is None:
-            if n.parent is None:
-                self.root = n.child[1]
-                self.root.parent = None
-                return
-            self.set_children(n.parent, n.key, n.child[1])
-            to_trace = n.child[1]
-        elif n.child[1] is None:
-            if n.parent is None:
-                self.root = n.child[0]
-                self.root.parent = None
-                return
-            self.set_children(n.parent, n.key, n.child[0])
-            to_trace = n.child[0]
-        # two children
-        else:
-            temp = n.child[0].max()
-            n.key, n.value = temp.key, temp.value
-            self.set_children(temp.parent, temp.key, temp.child[0])
-            if temp.child[0] is not None:
-                self.trace_heights(temp.child[0])
-            self.trace_heights(temp)
-            return
+    def rank(self, key) -> int:
+        """ Returns the number of keys strictly less than key. """
+        n, i = self.root, 0
+        while n is not None:
+            if n.key < key:
+                i += 1 + size(n.left)
+                n = n.right
+            else:
+                n = n.left
+        return i
 
-        self.trace_heights(to_trace)
-        self.trace(to_trace)
+    def select(self, i: int):
+        """ Returns the node with the i-th smallest key (starting from 0). """
+        n = self.root
+        while n is not None:
+            left = size(n.left)
+            if i == left:
+                return n
+            if i < left:
+                n = n.left
+            else:
+                i, n = i - left - 1, n.right
+        raise IndexError("index out of range")
+
+    def prefix_sum(self, i: int):
+        """ Returns the sum of the weights of the i smallest keys. """
+        if self.weight is None:
+            raise ValueError("prefix_sum needs a tree with a weight")
+        n, total = self.root, 0
+        while n is not None and i > 0:
+            left = size(n.left)
+            if i <= left:
+                n = n.left
+            else:
+                total += (n.left.total if n.left is not None else 0) + self.weight(n.key)
+                i, n = i - left - 1, n.right
+        return total
+
+    def lower(self, key):
+        """ Returns the node with the largest key strictly less than key. """
+        n, best = self.root, None
+        while n is not None:
+            if n.key < key:
+                best, n = n, n.right
+            else:
+                n = n.left
+        return best
+
+    def higher(self, key):
+        """ Returns the node with the smallest key strictly greater than key. """
+        n, best = self.root, None
+        while n is not None:
+            if n.key > key:
+                best, n = n, n.left
+            else:
+                n = n.right
+        return best
+
+    def delete(self, key, value=None):
+        self.remove(self.find(key, value))
+
+    def remove(self, n) -> None:
+        """ Removes a node from the tree. """
+        # two children: take the place of the successor, which has at most one
+        if n.left is not None and n.right is not None:
+            s = n.right.min()
+            n.key, n.value = s.key, s.value
+            n = s
+        c = n.left if n.left is not None else n.right
+        if c is not None:
+            c.parent = n.parent
+        self.replace(n, c)
+        if n.parent is not None:
+            self.retrace(n.parent)
 
     def update(self, key, value, new):
         self.delete(key, value)
@@ -111,67 +249,63 @@ class BST:
 
     def pop(self):
         n = self.min()
-        self.delete(n.key, n.value)
-        return n.key, n.value
+        key, value = n.key, n.value
+        self.remove(n)
+        return key, value
+
+    def replace(self, n, c) -> None:
+        """ Puts c where n is in n's parent. """
+        p = n.parent
+        if p is None:
+            self.root = c
+        elif p.left is n:
+            p.left = c
+        else:
+            p.right = c
 
-    def set_children(self, n, key, value):
-        n.child[key > n.key] = value
-        if value is not None:
-            value.parent = n
+    def update_height(self, n) -> None:
+        l, r = n.left, n.right
+        n.height = max(height(l), height(r)) + 1
+        n.size = 1 + size(l) + size(r)
+        if self.weight is not None:
+            n.total = self.weight(n.key) + (l.total if l is not None else 0) + (r.total if r is not None else 0)
 
-    def trace_heights(self, n):
+    def retrace(self, n) -> None:
+        """ Walks up to the root, fixing heights, sizes and balance. """
         while n is not None:
             self.update_height(n)
+            balance = height(n.right) - height(n.left)
+            if balance > 1:
+                if n.right.balance < 0:
+                    self.rotate_right(n.right)
+                n = self.rotate_left(n)
+            elif balance < -1:
+                if n.left.balance > 0:
+                    self.rotate_left(n.left)
+                n = self.rotate_right(n)
             n = n.parent
 
-    def update_height(self, n):
-        left = n.child[0].height if n.child[0] is not None else 0
-        right = n.child[1].height if n.child[1] is not None else 0
-        n.height = max(left, right) + 1
-        n.balance = right - left
-
-    def trace(self, n):
-        while n.parent is not None:
-            p = n.parent
-            # right child
-            if n.key > p.key:
-                if p.balance == 2:
-                    (self.rotate_right_left if n.balance < 0 else self.rotate_left)(p, n)
-            else:
-                if p.balance == -2:
-                    (self.rotate_left_right if n.balance > 0 else self.rotate_right)(p, n)
-            n = p
-
-    def rotate(self, p, n, d):
-        c = n.child[d]
-        p.child[d ^ 1] = c
-
-        if c is not None:
-            c.parent = p
-        n.child[d] = p
-
+    def rotate_left(self, p):
+        n = p.right
+        p.right = n.left
+        if n.left is not None:
+            n.left.parent = p
         n.parent = p.parent
-        if p.parent is not None:
-            p.parent.child[p.key > p.parent.key] = n
-        else:
-            self.root = n
-        p.parent = n
-
+        self.replace(p, n)
+        n.left, p.parent = p, n
         # order matters: update from the bottom up
         self.update_height(p)
         self.update_height(n)
-
         return n
 
-    def rotate_left(self, p, n):
-        return self.rotate(p, n, 0)
-
-    def rotate_right(self, p, n):
-        return self.rotate(p, n, 1)
-
-    def rotate_left_right(self, p, n):
-        return self.rotate_right(p, self.rotate_left(n, n.child[1]))
-
-    def rotate_right_left(self, p, n):
-        return self.rotate_left(p, self.rotate_right(n, n.child[0]))
-
+    def rotate_right(self, p):
+        n = p.left
+        p.left = n.right
+        if n.right is not None:
+            n.right.parent = p
+        n.parent = p.parent
+        self.replace(p, n)
+        n.right, p.parent = p, n
+        self.update_height(p)
+        self.update_height(n)
+        return n
@@ -0,0 +1,68 @@
+# Cache of rendered pages
+# Pages which look the same to every visitor who isn't signed in are rendered once and kept for a while.
+# A page can also depend on tags, which the code changing its data invalidates, dropping it in every worker.
+import os, time, hashlib, functools, threading
+import flask
+import db
+
+FOLDER = db.FILES + "cache/"
+# most pages kept by one worker
+SIZE = 256
+
+pages, lock = {}, threading.Lock()
+
+def stamp(tag: str) -> tuple:
+    """ Changes whenever a tag is invalidated. """
+    try:
+        stat = os.stat(FOLDER + tag)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+def invalidate(*tags: str) -> None:
+    """ Drops the pages which depend on any of the tags, in every worker. """
+    os.makedirs(FOLDER, exist_ok=True)
+    for tag in tags:
+        # replaced rather than touched, so the stamp changes even within the resolution of mtime
+        temp = "{}{}.{}.tmp".format(FOLDER, tag, os.getpid())
+        with open(temp, "w") as f:
+            f.write(str(time.time()))
+        os.replace(temp, FOLDER + tag)
+
+def cacheable() -> bool:
+    """ Returns whether the request gets the same page as every other visitor who isn't signed in. """
+    return flask.request.method == "GET" and "account" not in flask.session and "_flashes" not in flask.session
+
+def page(ttl: float, tags: list=[], vary=lambda: ()):
+    """ Caches a page for ttl seconds or until one of its tags is invalidated, separately for each value of vary(). """
+    def decorator(f):
+        @functools.wraps(f)
+        def func(*args, **kwargs):
+            if not cacheable():
+                return f(*args, **kwargs)
+            key = (flask.request.url_root, flask.request.path) + tuple(vary())
+            # taken before rendering, so an invalidation during it isn't missed
+            stamps = [stamp(tag) for tag in tags]
+            entry = pages.get(key)
+            if entry is None or time.time() > entry["expires"] or entry["stamps"] != stamps:
+                response = flask.make_response(f(*args, **kwargs))
+                if response.status_code != 200 or not cacheable():
+                    return response
+                body = response.get_data()
+                entry = {"body": body, "mimetype": response.mimetype, "etag": hashlib.md5(body).hexdigest(),
+                         "modified": time.time(), "expires": time.time() + ttl, "stamps": stamps}
+                with lock:
+                    pages.pop(key, None)
+                    pages[key] = entry
+                    # oldest first
+                    while len(pages) > SIZE:
+                        pages.pop(next(iter(pages)))
+
+            response = flask.Response(entry["body"], mimetype=entry["mimetype"])
+            response.set_etag(entry["etag"])
+            response.last_modified = entry["modified"]
+            # browsers keep the page but check with an If-None-Match, which is answered with a 304
+            response.cache_control.no_cache = True
+            return response.make_conditional(flask.request.environ)
+        return func
+    return decorator
@@ -1,4 +1,4 @@
-import json, pickle, os, getpass, glob, subprocess
+import json, pickle, os, getpass, glob, functools
 import markdown2
 import yagmail
 import numpy as np
@@ -19,7 +19,7 @@ from bs4 import BeautifulSoup
 import flask
 from requests_oauthlib import OAuth2Session
 from rdoclient_py3 import RandomOrgClient
-import forms, statistics
+import forms, statistics, wca, db, visits, cache
 # TODO: remove star import
 from dates import *
 
@@ -36,15 +36,37 @@ EXT_MODE = {"json": "", "pickle": "b", "text": ""}
 
 def load_file(fname: str, func: str="json", short: bool=True) -> dict:
     """ Loads a file. """
+    # documents in files/ go through the configured storage backend
+    if func == "json" and short:
+        return db.storage(fname).load(fname)
     with open("files/{}.{}".format(fname, func) if short else fname, "r" + EXT_MODE[func]) as f:
         return STR_FUNC["load"][func](f)
 
 def dump_file(obj, fname: str, func:str="json", short: bool=True) -> None:
     """ Dumps an obj into a file. """
+    if func == "json" and short:
+        return db.storage(fname).dump(obj, fname)
     with open("files/{}.{}".format(fname, func) if short else fname, "w" + EXT_MODE[func]) as f:
         STR_FUNC["dump"][func](obj, f, **({"indent": 4, "sort_keys": True} if func == "json" else {}))
 
+def load_entry(fname: str, *keys, default=None):
+    """ Loads one value of a document without reading the rest of it, where the backend allows. """
+    return db.storage(fname).get(fname, *keys, default=default)
+
+def dump_entry(value, fname: str, *keys) -> None:
+    """ Dumps one value into a document. """
+    db.storage(fname).set(value, fname, *keys)
+
+def update_file(fname: str, short: bool=True):
+    """ Loads a JSON file to change in place, locked against other workers and dumped atomically at the end. """
+    if short:
+        return db.storage(fname).transaction(fname)
+    folder, name = os.path.split(fname)
+    # documents outside of files/ still keep their lock in it
+    return db.File(folder + "/" if folder else "", db.FILES).transaction(os.path.splitext(name)[0])
+
 CONFIG = load_file("config")
+db.configure(CONFIG.get("storage", "json"))
 WCA = "https://www.worldcubeassociation.org"
 LECTURES = "static/pdfs/cubing-lectures/"
 FILE = ".html.j2"
@@ -67,6 +89,16 @@ ICONS = ['event-333', 'event-222', 'event-444', 'event-555', 'event-666', 'event
 ICONS = dict(zip(EVENTS, ICONS))
 RANKS = ["nr", "cr", "wr"]
 NAME_DELIM = "|"
+# number of formatted times remembered, every cell on the records and rankings pages fits
+TIME_CACHE = 1 << 12
+# TJ's SoR and Kinch are computed from these documents, and cached until they change
+METRIC_FILES = ["records", "wca/cache"]
+# the regional peers shown next to TJ on the WCA stats page
+COUNTRY = "USA"
+PEERS = 10
+# seconds between checking whether vote.json changed, writes from this worker show up right away
+VOTE_CHECK = 1
+vote_checked, vote_version = 0, None
 
 https = load_file("site")["url"][:5] == "https"
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = str(int(not https))
@@ -147,13 +179,7 @@ def get_comps() -> list:
 
 def parse_time(s: str) -> float:
     """ Parses a time string into the number of seconds. """
-    if s == "":
-        return statistics.DNF
-    # MBLD
-    if "/" in s:
-        solved, attempted = s.split("/")
-        return 2*int(solved) - int(attempted.split()[0])
-    return round(sum(60**(len(s.split(":")) - 1 - i)*float(token) for i, token in enumerate(s.split(":"))), 2)
+    return statistics.parse_time(s, 2)
 
 def add_zero(s: str, i: int) -> str:
     """ Adds "0" as a suffix or prefix if it needs it. """
@@ -163,8 +189,9 @@ def add_zero(s: str, i: int) -> str:
         return "0" + s
     return s
 
+@functools.lru_cache(maxsize=TIME_CACHE)
 def time_formatted(event:str, mode:str, t: float, dnf: bool=False) -> str:
-    """ Reverses parse_time """
+    """ Reverses parse_time. Memoized since templates call it for every cell. """
     if t == statistics.DNF:
         return "DNF" if dnf else ""
     if event in ["3x3x3 Fewest Moves", "3x3x3 Multi-Blind"]:
@@ -259,30 +286,51 @@ def parse_search(query: str) -> list:
 
 def store_candidate(d: dict) -> None:
     """ Stores a candidate to vote.json. """
-    vote = load_file("vote")
     d["time"] = time.time()
     d["timestr"] = unix_to_human(time.time())
     #"client side validation big stupid" - Darin Mao
     d["description"] = d["description"][:forms.LENGTH]
-    vote["candidates"][d["name"]] = d
-    dump_file(vote, "vote")
+    with update_file("vote") as vote:
+        vote["candidates"][d["name"]] = d
+    reload_vote()
+    cache.invalidate("vote")
+
+@functools.lru_cache(maxsize=1)
+def find_vote(version: tuple) -> tuple:
+    """ Parses vote.json and its deadline once per version. """
+    vote = load_file("vote")
+    return vote, short_date(vote["ends_at"])
+
+def reload_vote() -> None:
+    """ Makes the next get_vote check whether vote.json changed. """
+    global vote_checked
+    vote_checked = 0
+
+def get_vote() -> dict:
+    """ Returns vote.json, with vote_active turned off by the clock once the vote ends. """
+    global vote_checked, vote_version
+    if time.time() - vote_checked > VOTE_CHECK:
+        vote_checked, vote_version = time.time(), db.storage("vote").version("vote")
+    vote, ends_at = find_vote(vote_version)
+    return dict(vote, vote_active=vote.get("vote_active", False) and time.time() <= ends_at)
 
 def get_candidates() -> list:
     """ Returns a list of candidates, sorted by entry time. """
-    candidates = list(load_file("vote")["candidates"].values())
+    candidates = list(get_vote()["candidates"].values())
     candidates.sort(key=lambda d: d["time"])
     return candidates
 
 def add_vote(name: str, candidate: str) -> None:
     """ Adds a vote from name to candidate. """
-    vote = load_file("vote")
-    vote["votes"][name] = candidate
-    dump_file(vote, "vote")
+    with update_file("vote") as vote:
+        vote["votes"][name] = candidate
+    reload_vote()
+    cache.invalidate("vote")
 
 def get_winner() -> str:
     """ Returns the winner of the election. """
     count = {}
-    for vote in load_file("vote")["votes"].values():
+    for vote in get_vote()["votes"].values():
         count[vote] = count.get(vote, 0) + 1
     winner = max(count, key=lambda v: count[v])
     votes = count[winner]
@@ -442,7 +490,7 @@ def valid_voter() -> bool:
     if not flask.session.get("valid_voter", False):
         signups = get_signups()
         total, annual = count_meetings(signups, datetime.min, datetime.max), count_meetings(signups)
-        cutoff = load_file("vote")["min_meetings"]
+        cutoff = get_vote()["min_meetings"]
         flask.session["valid_voter"] = annual >= cutoff or total >= 2*cutoff
     return flask.session["valid_voter"]
 
@@ -463,36 +511,36 @@ def add_xmltag(soup, element, seen, name, default, update=False):
 def edit_sitemap(use_json=True) -> None:
     """ Changes the URL on the sitemap and modification times. """
     soup = make_soup(SITEMAP, "file", "xml")
-    seen = load_file("sitemap") if use_json else {}
-    for child in soup.find_all("url"):
-        loc = child.find("loc")
-        path = "/".join(loc.text.split("/")[3:]).strip()
-        if path not in seen or use_json:
-            if not use_json:
-                seen[path] = {}
-
-            seen[path]["loc"] = seen[path].get("loc", TJ + path)
-            loc.string.replace_with(seen[path]["loc"])
-            fname = "templates/" + path + FILE
-            if not os.path.isfile(fname):
-                if path in ["robots.txt", "sitemap.xml"]:
-                    fname = "static/" + path
-                elif path in [""]:
-                    fname = "templates/index" + FILE
-                else:
-                    fname = None
-
-            mtime = datetime.fromtimestamp(os.path.getmtime(fname)).isoformat() if fname is not None else None
-            for args in [("lastmod", mtime, True), ("changefreq", "yearly", False), ("priority", 0.0, False)]:
-                add_xmltag(soup, child, seen[path], *args)
-
-        else:
-            child.decompose()
+    with update_file("sitemap") as seen:
+        if not use_json:
+            seen.clear()
+        for child in soup.find_all("url"):
+            loc = child.find("loc")
+            path = "/".join(loc.text.split("/")[3:]).strip()
+            if path not in seen or use_json:
+                if not use_json:
+                    seen[path] = {}
+
+                seen[path]["loc"] = seen[path].get("loc", TJ + path)
+                loc.string.replace_with(seen[path]["loc"])
+                fname = "templates/" + path + FILE
+                if not os.path.isfile(fname):
+                    if path in ["robots.txt", "sitemap.xml"]:
+                        fname = "static/" + path
+                    elif path in [""]:
+                        fname = "templates/index" + FILE
+                    else:
+                        fname = None
+
+                mtime = datetime.fromtimestamp(os.path.getmtime(fname)).isoformat() if fname is not None else None
+                for args in [("lastmod", mtime, True), ("changefreq", "yearly", False), ("priority", 0.0, False)]:
+                    add_xmltag(soup, child, seen[path], *args)
 
-    with open(SITEMAP, "w") as f:
-        f.write(soup.prettify())
+            else:
+                child.decompose()
 
-    dump_file(seen, "sitemap")
+        with open(SITEMAP, "w") as f:
+            f.write(soup.prettify())
 
 def github_commit_time() -> str:
     """ Returns the time of the last Github commit. """
@@ -506,9 +554,9 @@ def get_pfp(name: str, client: Client=None) -> Client:
     """ Gets the Facebook profile picture of a person, and saves the profile location. """
     client = make_client() if client is None else client
     user = client.searchForUsers(name)[0]
-    d = load_file("fb")
-    d[name] = user.url
-    dump_file(d, "fb")
+    with update_file("fb") as d:
+        d[name] = user.url
+    cache.invalidate("fb")
     with open("src/img/pfps/{}.png".format(name.replace(" ", "")), "wb") as f:
         f.write(requests.get(user.photo).content)
     return client
@@ -525,30 +573,48 @@ def get_errors() -> list:
 
 def register(username: str, password: str) -> None:
     """ Registers a new user account. """
-    users = load_file("users")
-    user = users[username] = {}
-    user["hash"] = pbkdf2_sha512.hash(password)
-    user["scope"] = "default"
-    user["keys"] = []
-    user["encrypt"] = True
-    dump_file(users, "users")
+    # hashing is slow, so do it before taking the lock
+    user = {"hash": pbkdf2_sha512.hash(password), "scope": "default", "keys": [], "encrypt": True}
+    with update_file("users") as users:
+        users[username] = user
+
+@functools.lru_cache(maxsize=1)
+def find_users(version: tuple) -> dict:
+    """ Indexes users.json by username once per version, keeping each user serialized until it's asked for. """
+    return {username: json.dumps(user) for username, user in load_file("users").items()}
+
+def get_user(username: str, default=None) -> dict:
+    """ Returns one user, parsed at most once per request. """
+    if username is None:
+        return default
+    # writes change the version, which is checked every time so a changed user is never stale
+    version = db.storage("users").version("users")
+    memo = flask.g.setdefault("users", {}) if flask.has_app_context() else {}
+    if memo.get(username, (None,))[0] != version:
+        if isinstance(db.storage("users"), db.Database):
+            # a point lookup of one row, without parsing the rest of the users
+            memo[username] = version, load_entry("users", username)
+        else:
+            user = find_users(version).get(username)
+            memo[username] = version, json.loads(user) if user is not None else None
+    user = memo[username][1]
+    return user if user is not None else default
 
 def check(username: str, password: str) -> bool:
     """ Determines whether a login is legitimate or not. """
-    user = load_file("users").get(username, None)
+    user = get_user(username)
     return user is not None and pbkdf2_sha512.verify(password, user["hash"])
 
 def check_2fa(username: str, code: str) -> bool:
     """ Determines whether the 2fa code is valid. """
-    user = load_file("users").get(username, None)
+    user = get_user(username)
     return user is not None and pyotp.TOTP(user["2fa"]).verify(code)
 
 def prompt_email(email: str) -> None:
     """ Sends a email asking for verification. """
-    emails = load_file("emails")
     nonce = gen_secret()
-    emails["requests"][nonce] = email
-    dump_file(emails, "emails")
+    with update_file("emails") as emails:
+        emails["requests"][nonce] = email
     body = f"""Please click <a href="{load_file("site")["url"] + f"/email?nonce={nonce}"}">here</a> to be added to the mailing list.
 
 --
@@ -557,10 +623,9 @@ If you did not request this email, discard this message."""
 
 def unsubscribe_email(email: str) -> None:
     """ Sends a email confirming the unsubscription. """
-    emails = load_file("emails")
     nonce = gen_secret()
-    emails["unsubscribe-requests"][nonce] = email
-    dump_file(emails, "emails")
+    with update_file("emails") as emails:
+        emails["unsubscribe-requests"][nonce] = email
     body = f"""Please click <a href="{load_file("site")["url"] + f"/email?nonce={nonce}"}">here</a> to be removed from the mailing list.
 
 --
@@ -569,17 +634,15 @@ If you did not request this email, discard this message."""
 
 def register_email(email: str) -> None:
     """ Stores an email in the mailing list. """
-    emails = load_file("emails")
-    if email not in emails["emails"]:
-        emails["emails"].append(email)
-    dump_file(emails, "emails")
+    with update_file("emails") as emails:
+        if email not in emails["emails"]:
+            emails["emails"].append(email)
 
 def remove_email(email: str) -> None:
     """ Removes an email from the mailing list. """
-    emails = load_file("emails")
-    if email in emails["emails"]:
-        emails["emails"].remove(email)
-    dump_file(emails, "emails")
+    with update_file("emails") as emails:
+        if email in emails["emails"]:
+            emails["emails"].remove(email)
 
 # TODO: blind cc
 def send_email(recipients: list, subject: str, body: str) -> None:
@@ -589,21 +652,16 @@ def send_email(recipients: list, subject: str, body: str) -> None:
 
 def save_email(subject: str, body: str) -> None:
     """ Saves an email to disk. """
-    mails = load_file("mails.json", "json", False)
-    mails.append({"subject": subject, "body": body, "time": time.time()})
-    dump_file(mails, "mails.json", "json", False)
+    with update_file("mails.json", False) as mails:
+        mails.append({"subject": subject, "body": body, "time": time.time()})
+    cache.invalidate("mails")
 
 def update_records() -> None:
     """ Updates the records page. """
+    # fetching the profiles takes a while, so only lock records to merge the results back
     records = load_file("records")
     times, people = records["records"], records["people"]
 
-    # If graduated, add to alumni list 
-    graduated = [person for person in people if datetime.now() > summer(person[-1])]
-    if len(graduated) > 0:
-        alumni = load_file("alumni")
-        # first entry is WCA profile url, second is name
-        dump_file(alumni + [person[1] for person in graduated], "alumni")
     # Remove alumni
     people = [person for person in people if datetime.now() < summer(person[-1])]
 
@@ -622,12 +680,21 @@ def update_records() -> None:
                     for rank in ["nr", "cr", "wr"]:
                         times[event][cat][rank] = prs[event][cat][rank]
 
-    dump_file({"records": times, "people": people, "time": time.time()}, "records")
+    with update_file("records") as records:
+        records["records"], records["time"] = times, time.time()
+        # people added in the meantime are kept for the next update
+        graduated = [person for person in records["people"] if datetime.now() > summer(person[-1])]
+        records["people"] = [person for person in records["people"] if person not in graduated]
+    cache.invalidate("records")
 
-def get_sor() -> dict:
-    """ Gets TJ's single and average sum of ranks (SoR). """
-    times = load_file("records")["records"]
-    rankd = load_file("wca/cache")["ranks"]
+    # If graduated, add to alumni list
+    if len(graduated) > 0:
+        with update_file("alumni") as alumni:
+            # first entry is WCA profile url, second is name
+            alumni.extend(person[1] for person in graduated)
+
+def find_sor(times: dict, rankd: dict) -> dict:
+    """ Computes TJ's single and average sum of ranks (SoR). """
     d = {"single": {}, "average": {}}
     for event in EVENTS:
         short = ICONS[event][6:]
@@ -641,6 +708,10 @@ def get_sor() -> dict:
 
     return d
 
+def get_sor() -> dict:
+    """ Gets TJ's single and average sum of ranks (SoR). """
+    return get_metrics()[0]
+
 def get_sor_ranks() -> tuple:
     """ Gets the rank of TJ's SoR. """
     ranks = get_sor()
@@ -652,10 +723,8 @@ def kinch(wrd: dict, event: str, mode: str, sing: float) -> float:
         return 0
     return 100*((wrd[mode][event]/100)/sing if event != "333mbf" else sing/wrd[mode][event])
 
-def get_kinch() -> dict:
-    """ Gets TJ's kinch score. """
-    times = load_file("records")["records"]
-    wrd = load_file("wca/cache")["wrs"]
+def find_kinch(times: dict, wrd: dict) -> dict:
+    """ Computes TJ's kinch score. """
     d = {}
 
     for event in EVENTS:
@@ -672,18 +741,54 @@ def get_kinch() -> dict:
 
     return d
 
+def get_kinch() -> dict:
+    """ Gets TJ's kinch score. """
+    return get_metrics()[1]
+
+def metrics_version() -> tuple:
+    """ Returns the versions of the documents SoR and Kinch are computed from. """
+    return tuple(db.storage(name).version(name) for name in METRIC_FILES)
+
+@functools.lru_cache(maxsize=1)
+def find_metrics(version: tuple) -> tuple:
+    """ Computes TJ's SoR and Kinch from one load of the records and the WCA cache. """
+    times, cache = load_file("records")["records"], load_file("wca/cache")
+    return find_sor(times, cache["ranks"]), find_kinch(times, cache["wrs"])
+
+def get_metrics() -> tuple:
+    """ Returns TJ's SoR and Kinch, only recomputed once the records or the WCA cache change. """
+    sor, kinch = find_metrics(metrics_version())
+    # copies, so callers can't change the cached results
+    return {mode: dict(ranks) for mode, ranks in sor.items()}, dict(kinch)
+
 def get_kinch_rank() -> int:
     """ Gets the rank of TJ's kinch. """
     return wca.kinch_rank(sum(get_kinch().values())/len(EVENTS))
 
 def get_ranks() -> tuple:
-    """ Returns the rank of SoR and Kinch. """
-    ranks, kinch = get_sor(), sum(get_kinch().values())/len(EVENTS)
-    sing, avg = sum(ranks["single"].values()), sum(ranks["average"].values())
-    out = subprocess.run(["python", "wca.py", str(sing), str(avg), str(kinch)],
-                         capture_output=True).stdout.decode()
-    sing_rank, avg_rank, kinch_rank = map(int, out.split())
-    return ((sing_rank, avg_rank), kinch_rank)
+    """ Returns the rank of SoR and Kinch, None if the WCA export hasn't been ingested. """
+    if not wca.available():
+        return None
+    ranks, kinch = get_metrics()
+    return wca.ranks(sum(ranks["single"].values()), sum(ranks["average"].values()), sum(kinch.values())/len(EVENTS))
+
+def get_peers(country: str=COUNTRY, n: int=PEERS) -> dict:
+    """ Returns the best persons of a country by SoR and Kinch, with TJ placed among them. """
+    # the page still renders from the cached ranks without an index
+    if not wca.available():
+        return {}
+    sor, kinch = get_metrics()
+    tables = {"sor_single": ("sor", "Single", sor["single"]),
+              "sor_average": ("sor", "Average", sor["average"]),
+              "kinch": ("kinch", "Average", kinch)}
+    peers = {}
+    for key, (metric, mode, scores) in tables.items():
+        total = sum(scores.values())/(len(EVENTS) if metric == "kinch" else 1)
+        rows = [dict(wca.breakdown(i, metric, mode), rank=rank + 1) for rank, i in enumerate(wca.top(metric, mode, n, country))]
+        rows.append({"rank": wca.place(total, metric, mode, country), "name": "TJHSST", "total": total, "scores": scores})
+        # TJ goes before the peers it ties with
+        peers[key] = sorted(rows, key=lambda row: (row["rank"], row["name"] != "TJHSST"))
+    return peers
 
 def get_inhouse_dates() -> list:
     """ Returns a list of all the past inhouse competitions, sorted by date. """
@@ -691,11 +796,13 @@ def get_inhouse_dates() -> list:
 
 def get_inhouse_results(date: str=get_inhouse_dates()[-1]) -> tuple:
     """ Returns a tuple of a list of tuples sorted by average and a list of scrambles. """
-    return (sorted(list(map(\
-    lambda x: [statistics.ao(list(map(parse_time, [t if t != "DNF" else "" for t in x.split(NAME_DELIM)[1].split()])))] + [x.split(NAME_DELIM)[0]] \
-    + list(map(parse_time, [t if t != "DNF" else "" for t in x.split(NAME_DELIM)[1].split()])), \
-    load_file("static/txt/{}res".format(date), "text", False).split("\n")[:-1]))), \
-    list(map(lambda x: " ".join(x.split()[1:]), load_file("static/txt/{}scr".format(date), "text", False).split("\n"))))
+    results = []
+    for line in load_file("static/txt/{}res".format(date), "text", False).split("\n")[:-1]:
+        name, times = line.split(NAME_DELIM)
+        times = list(statistics.parse_many(times.split(), 2))
+        results.append([statistics.ao(times), name] + times)
+    return (sorted(results),
+            list(map(lambda x: " ".join(x.split()[1:]), load_file("static/txt/{}scr".format(date), "text", False).split("\n"))))
 
 def get_photos() -> list:
     """ Returns a list of paths to photos. """
@@ -705,7 +812,7 @@ def get_photos() -> list:
 def graph_vists():
     """ Graphs the frequency of page visits. """
     try:
-        vists = load_file("vists")
+        vists = visits.load()
         keys = [day for day in vists["/"]]
         days = pd.to_datetime(keys)
         calmap.yearplot(pd.Series([vists["/"][k] for k in keys], index=days), year=get_year())
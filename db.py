@@ -1,16 +1,312 @@
 # Library for psuedo-database things
+# Every piece of state is a JSON document, kept either as a file or in SQLite.
+import json, os, glob, fcntl, tempfile, collections, sqlite3, threading, contextlib, argparse
 
-# class File:
-#
-#     def __init__(self):
-#         pass
-#
-#     def __access__(value):
-#         if value is None:
-#             return load_file(self.file)
-#         return load_file(self.file)[value]
-#
-#     def __modify__(key, value):
-#         temp = self.__access__(None)
-#         temp[key] = value
-#         dump_file(temp, self.file)
+FILES = "files/"
+DATABASE = FILES + "cube.db"
+# hand edited settings and the WCA cache written by wca.py always stay files
+KEEP = ["config", "secrets", "site"]
+
+def walk(value, keys: tuple):
+    """ Follows keys down into nested dicts and lists. """
+    for key in keys:
+        value = value[key]
+    return value
+
+def mode(path: str) -> int:
+    """ Returns the permissions of a file, or what open() would create it with. """
+    try:
+        return os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+class File:
+    """ Stores each document as a JSON file, which is fully read and rewritten. """
+
+    def __init__(self, folder: str=FILES, locks: str=None):
+        self.folder = folder
+        # where the lock files go, next to the documents unless that's somewhere they'd be in the way
+        self.lock_folder = folder if locks is None else locks
+        # greenlets of one worker queue up here instead of blocking the whole worker on flock
+        self.locks = collections.defaultdict(threading.Lock)
+
+    def path(self, name: str) -> str:
+        return "{}{}.json".format(self.folder, name)
+
+    @contextlib.contextmanager
+    def lock(self, name: str):
+        """ Holds the lock of a document, shared by every process. """
+        # the document itself is replaced on every write, so lock a file next to it
+        with self.locks[name], open("{}{}.json.lock".format(self.lock_folder, name), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def transaction(self, name: str):
+        """ Yields a document to change in place, which is saved when the block exits without an error. """
+        with self.lock(name):
+            obj = self.load(name)
+            yield obj
+            self.write(obj, name)
+
+    def load(self, name: str):
+        with open(self.path(name)) as f:
+            return json.load(f)
+
+    def dump(self, obj, name: str) -> None:
+        with self.lock(name):
+            self.write(obj, name)
+
+    def write(self, obj, name: str) -> None:
+        """ Replaces a document all at once, so readers never see half of one. """
+        folder, fname = os.path.split(self.path(name))
+        fd, temp = tempfile.mkstemp(prefix=fname + ".", suffix=".tmp", dir=folder or ".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(obj, f, indent=4, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp only lets the owner read it, so keep the mode of the document it replaces
+            os.chmod(temp, mode(self.path(name)))
+            os.replace(temp, self.path(name))
+        except:
+            os.unlink(temp)
+            raise
+
+    def get(self, name: str, *keys, default=None):
+        """ Returns the value at keys in a document, default if there isn't one. """
+        try:
+            return walk(self.load(name), keys)
+        except (KeyError, IndexError, TypeError):
+            return default
+
+    def set(self, value, name: str, *keys) -> None:
+        """ Puts a value at keys in a document. """
+        with self.transaction(name) as obj:
+            walk(obj, keys[:-1])[keys[-1]] = value
+
+    def delete(self, name: str, *keys) -> None:
+        with self.transaction(name) as obj:
+            walk(obj, keys[:-1]).pop(keys[-1], None)
+
+    def version(self, name: str) -> tuple:
+        """ Changes whenever the document does. """
+        stat = os.stat(self.path(name))
+        return stat.st_mtime_ns, stat.st_size
+
+    def names(self) -> list:
+        return sorted(os.path.basename(fname)[:-len(".json")] for fname in glob.glob(self.folder + "*.json"))
+
+class Database(File):
+    """ Stores the top-level entries of each document as rows of SQLite, so point lookups only parse one entry. """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, kind TEXT NOT NULL, version INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS entries (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                                            PRIMARY KEY (name, key)) WITHOUT ROWID;
+    """
+    # the single row of a document which isn't a dict
+    WHOLE = ""
+
+    # idle connections kept by each process
+    POOL = 4
+
+    def __init__(self, fname: str=DATABASE):
+        super().__init__()
+        self.fname = fname
+        # the connection lent to each thread (or greenlet, under gevent) for the block it's in
+        self.local = threading.local()
+        self.pool, self.pool_lock, self.pid = [], threading.Lock(), None
+
+    def open(self) -> sqlite3.Connection:
+        # a pooled connection can be lent to a different thread each time
+        connection = sqlite3.connect(self.fname, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def take(self) -> sqlite3.Connection:
+        """ Takes an idle connection of this process, or opens one. """
+        with self.pool_lock:
+            # connections can't cross a fork, and the schema only needs creating once per process
+            if self.pid != os.getpid():
+                self.pool, self.pid = [], os.getpid()
+                connection = self.open()
+                # readers never block the writer, and the other way around
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(self.SCHEMA)
+                return connection
+            if self.pool:
+                return self.pool.pop()
+        return self.open()
+
+    @contextlib.contextmanager
+    def connect(self):
+        """ Lends a connection for a block, the same one to the blocks inside it. """
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            yield connection
+            return
+        connection = self.local.connection = self.take()
+        try:
+            yield connection
+        finally:
+            self.local.connection = None
+            with self.pool_lock:
+                if self.pid == os.getpid() and len(self.pool) < self.POOL:
+                    self.pool.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    @contextlib.contextmanager
+    def immediate(self):
+        """ Takes the write lock of the database up front, so a read can't go stale before the write. """
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                yield c
+            except:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+
+    def kind(self, name: str) -> str:
+        with self.connect() as c:
+            row = c.execute("SELECT kind FROM documents WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(name)
+        return row[0]
+
+    def load(self, name: str):
+        with self.connect() as c:
+            kind = self.kind(name)
+            rows = c.execute("SELECT key, value FROM entries WHERE name = ?", (name,))
+            if kind == "dict":
+                return {key: json.loads(value) for key, value in rows}
+            return json.loads(rows.fetchone()[1])
+
+    @contextlib.contextmanager
+    def transaction(self, name: str):
+        with self.immediate() as c:
+            obj = self.load(name)
+            yield obj
+            self.save(c, obj, name)
+
+    def dump(self, obj, name: str) -> None:
+        with self.immediate() as c:
+            self.save(c, obj, name)
+
+    def save(self, c, obj, name: str) -> None:
+        """ Writes a document, only touching the entries which changed. """
+        kind = "dict" if isinstance(obj, dict) else "value"
+        new = {key: json.dumps(value, sort_keys=True) for key, value in obj.items()} if kind == "dict" else \
+              {self.WHOLE: json.dumps(obj, sort_keys=True)}
+        old = dict(c.execute("SELECT key, value FROM entries WHERE name = ?", (name,)))
+        c.executemany("DELETE FROM entries WHERE name = ? AND key = ?", [(name, key) for key in old if key not in new])
+        c.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                      [(name, key, value) for key, value in new.items() if old.get(key) != value])
+        self.touch(c, name, kind)
+
+    def touch(self, c, name: str, kind: str) -> None:
+        c.execute("""INSERT INTO documents VALUES (?, ?, 1)
+                     ON CONFLICT (name) DO UPDATE SET kind = excluded.kind, version = version + 1""", (name, kind))
+
+    def split(self, name: str, keys: tuple) -> tuple:
+        """ Returns the row a path of keys is in, and the rest of the path. """
+        if self.kind(name) == "dict":
+            return keys[0], keys[1:]
+        return self.WHOLE, keys
+
+    def get(self, name: str, *keys, default=None):
+        if not keys:
+            return self.load(name)
+        key, rest = self.split(name, keys)
+        # SQLite follows the rest of the path itself, unless a key can't be quoted in a JSON path
+        if all(isinstance(k, int) or '"' not in k for k in rest):
+            json_path = "$" + "".join("[{}]".format(k) if isinstance(k, int) else '."{}"'.format(k) for k in rest)
+            # json_extract rather than ->, which needs SQLite 3.38
+            with self.connect() as c:
+                row = c.execute("SELECT json_type(value, ?), json_extract(value, ?) FROM entries WHERE name = ? AND key = ?",
+                                (json_path, json_path, name, key)).fetchone()
+            if row is None or row[0] is None:
+                return default
+            kind, value = row
+            # json_extract gives SQL values: text for strings, objects and arrays, and 0 or 1 for booleans
+            return json.loads(value) if kind in ["object", "array"] else bool(value) if kind in ["true", "false"] else value
+        try:
+            return walk(self.get(name, *keys[:len(keys) - len(rest)]), rest)
+        except (KeyError, IndexError, TypeError):
+            return default
+
+    def set(self, value, name: str, *keys) -> None:
+        key, rest = self.split(name, keys)
+        with self.immediate() as c:
+            if rest:
+                row = c.execute("SELECT value FROM entries WHERE name = ? AND key = ?", (name, key)).fetchone()
+                if row is None:
+                    raise KeyError(key)
+                entry = json.loads(row[0])
+                walk(entry, rest[:-1])[rest[-1]] = value
+                value = entry
+            c.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (name, key, json.dumps(value, sort_keys=True)))
+            self.touch(c, name, self.kind(name))
+
+    def delete(self, name: str, *keys) -> None:
+        key, rest = self.split(name, keys)
+        with self.immediate() as c:
+            if rest:
+                row = c.execute("SELECT value FROM entries WHERE name = ? AND key = ?", (name, key)).fetchone()
+                if row is None:
+                    return
+                entry = json.loads(row[0])
+                walk(entry, rest[:-1]).pop(rest[-1], None)
+                c.execute("UPDATE entries SET value = ? WHERE name = ? AND key = ?", (json.dumps(entry, sort_keys=True), name, key))
+            else:
+                c.execute("DELETE FROM entries WHERE name = ? AND key = ?", (name, key))
+            self.touch(c, name, self.kind(name))
+
+    def version(self, name: str) -> tuple:
+        with self.connect() as c:
+            row = c.execute("SELECT version FROM documents WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(name)
+        return (row[0],)
+
+    def names(self) -> list:
+        with self.connect() as c:
+            return [row[0] for row in c.execute("SELECT name FROM documents ORDER BY name")]
+
+BACKENDS = {"json": File, "sqlite": Database}
+files = backend = File()
+
+def configure(kind: str="json") -> None:
+    """ Chooses where documents are stored. """
+    global backend
+    backend = BACKENDS[kind]()
+
+def storage(name: str) -> File:
+    """ Returns the backend a document is stored in. """
+    return files if name in KEEP or name.startswith("wca/") else backend
+
+def migrate(source: File, target: File) -> list:
+    """ Copies every document from one backend to another. """
+    names = [name for name in source.names() if name not in KEEP]
+    for name in names:
+        target.dump(source.load(name), name)
+    return names
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manages the documents in files/.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    move = commands.add_parser("migrate", help="move the documents between storage backends")
+    move.add_argument("source", choices=BACKENDS)
+    move.add_argument("target", choices=BACKENDS)
+    args = parser.parse_args()
+
+    for name in migrate(BACKENDS[args.source](), BACKENDS[args.target]()):
+        print("migrated", name)
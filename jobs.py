@@ -0,0 +1,32 @@
+# Runs slow jobs, like drawing the charts, in the background
+# Every job gets its own process, so a request only waits for it to start, under gevent or not.
+# A job holds a lock file for as long as it runs, so the workers never run the same job at the same time.
+import os, sys, fcntl, subprocess, threading
+import db
+
+FOLDER = db.FILES + "jobs/"
+
+def name(func: str, args: tuple) -> str:
+    return "_".join((func,) + args)
+
+def submit(func: str, *args: str) -> bool:
+    """ Runs cube.func(*args) in the background, unless it's running already. Returns whether it was started. """
+    os.makedirs(FOLDER, exist_ok=True)
+    fd = os.open(FOLDER + name(func, args) + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # the job inherits the lock, which is let go when it exits
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), func, *args], pass_fds=(fd,))
+    finally:
+        os.close(fd)
+    # reap it once it's done, a greenlet under gevent
+    threading.Thread(target=proc.wait, daemon=True).start()
+    return True
+
+if __name__ == "__main__":
+    import cube
+    func, *args = sys.argv[1:]
+    getattr(cube, func)(*args)
@@ -1,20 +1,54 @@
-import math
-# import pandas as pd
+import math, sys, io, csv, itertools, array, re
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
 
 # Computes various statistics
 
 DNF = float("INF")
+# sessions at least this long are averaged with NumPy
+LARGE = 1000
+# number of sorted window entries held in memory at once
+CHUNK = 1 << 20
+# sum() of floats uses Neumaier's compensated summation since Python 3.12
+NEUMAIER = sys.version_info >= (3, 12)
+# rolling averages in a session report: (name, size, trim), mo3 trims nothing
+AVERAGES = [("mo3", 3, 0), ("ao5", 5, 0.05), ("ao12", 12, 0.05), ("ao50", 50, 0.05),
+            ("ao100", 100, 0.05), ("ao1000", 1000, 0.05)]
+PERCENTILES = [10, 25, 50, 75, 90]
+# MBLD solved/attempted (and time), or [[h:]m:]s with csTimer's + for a +2
+TIME = re.compile(r"(\d+)/(\d+)(?:\s.*)?|(?:(?:(\d+):)?(\d+):)?(\d+\.?\d*|\.\d+)\+?")
 
-def parse_time(s: str) -> float:
-    """ Parses a string to a time. """
-    if s[0] == "(":
-        s = s[1:-1]
-
-    if s[-1] == "+":
-        return parse_time(s[:-1])
-    elif "DNF" in s:
+def parse_time(s: str, digits: int=None) -> float:
+    """ Parses a string to a time: [[h:]m:]s[+], DNF/DNS, (parenthesized) or MBLD x/y [time].
+        Empty strings are DNFs, seconds are rounded if digits is given. """
+    # fast path for plain seconds
+    try:
+        t = float(s)
+        if math.isfinite(t):
+            return round(t, digits) if digits is not None else t
+    except ValueError:
+        pass
+    s = s.strip()
+    if s[:1] == "(" and s[-1:] == ")":
+        s = s[1:-1].strip()
+    if s == "" or "DNF" in s or "DNS" in s:
         return DNF
-    return float(s)
+    match = TIME.fullmatch(s)
+    if match is None:
+        raise ValueError("could not parse time: {!r}".format(s))
+    solved, attempted, h, m, sec = match.groups()
+    # MBLD points
+    if solved is not None:
+        return 2*int(solved) - int(attempted)
+    t = 3600*int(h or 0) + 60*int(m or 0) + float(sec)
+    return round(t, digits) if digits is not None else t
+
+def parse_many(l: list, digits: int=None) -> array.array:
+    """ Parses many strings at once into an array of doubles. """
+    f = parse_time
+    return array.array("d", [f(s, digits) for s in l])
 
 def mean(l: list) -> float:
     """ Returns the mean of a list, rounded to two decimal places. """
@@ -37,39 +71,158 @@ def block(l: list, k: int=5, roll=False) -> list:
         times.append(bucket)
     return times
 
+def aos(l: list, k: int=5, roll=False, p: float=0.05) -> list:
+    """ Vectorized list(map(lambda b: ao(b, p), block(l, k, roll))), with identical results.
+        When p trims nothing it's list(map(mean, block(l, k, roll))), like aok.Window's moK. """
+    if np is None or (roll and len(l) < k):
+        return [ao(b, p) for b in block(l, k, roll)]
+    a = np.asarray(l, dtype=float)
+    # a read-only view of every window, sliding_window_view needs NumPy 1.20
+    windows = np.lib.stride_tricks.as_strided(a, (len(a) - k + 1, k), a.strides*2, writeable=False) if roll else \
+              a[:len(a)//k*k].reshape(-1, k)
+    drop = math.ceil(p*k)
+    rtn = []
+    for i in range(0, len(windows), max(CHUNK//k, 1)):
+        chunk = windows[i: i + max(CHUNK//k, 1)]
+        # an untrimmed mean adds the window up in order, like sum()
+        middle = np.sort(chunk, axis=1)[:, drop:-drop] if drop > 0 else chunk
+        if middle.shape[1] == 0:
+            raise ZeroDivisionError("division by zero")
+        # add column by column, exactly like sum() over a sorted list
+        total, c = np.zeros(len(middle)), np.zeros(len(middle))
+        with np.errstate(invalid="ignore"):
+            for j in range(middle.shape[1]):
+                x = middle[:, j]
+                t = total + x
+                if NEUMAIER:
+                    c += np.where(np.abs(total) >= np.abs(x), (total - t) + x, (x - t) + total)
+                total = t
+            if NEUMAIER:
+                total = np.where((c != 0) & np.isfinite(c), total + c, total)
+        # Python's round, not NumPy's, which rounds differently on halves
+        rtn += [round(x, 2) for x in (total/middle.shape[1]).tolist()]
+    return rtn
+
 def process(times: list) -> tuple:
     """ Returns the statistics given a time list. """
-    avgs = list(map(ao, block(times)))
+    avgs = aos(times) if len(times) >= LARGE else list(map(ao, block(times)))
     return "mo{}ao5".format(len(avgs)), mean(avgs), min(avgs)
 
-def parse(text: str) -> list:
-    """ Parses a CStimer CSV file. """
-    session = pd.read_csv(text, sep=";")
-    return list(map(parse_time, session["Time"].apply(str)))
+def percentile(l: list, q: float) -> float:
+    """ Linearly interpolated q-th percentile of a sorted list. """
+    i = q/100*(len(l) - 1)
+    lo = math.floor(i)
+    return round(float(l[lo] + (l[min(lo + 1, len(l) - 1)] - l[lo])*(i - lo)), 2)
+
+def rolling(session, k: int, trim: float) -> iter:
+    """ Returns the rolling averages of a session, with NumPy once the session is large. """
+    if len(session) < k:
+        return []
+    if np is not None and len(session) >= LARGE:
+        return aos(session, k, roll=True, p=trim)
+    # aok imports this module for ao and mean, so it's only imported once both are loaded
+    import aok
+    window = aok.Window(k, trim)
+    return (avg for avg in map(window.push, session) if avg is not None)
+
+def report(times: list) -> dict:
+    """ Computes every statistic of a session in a single pass over the times.
+        times can be any iterable, e.g. parse_stream. Only the times themselves are kept, 8 bytes a solve,
+        for the averages and the percentiles. """
+    session, solves, total = array.array("d"), 0, 0
+    # Welford's running mean and sum of squared deviations, which don't cancel like sum(t*t) - n*mean*mean
+    running, deviations = 0, 0
+    for t in times:
+        session.append(t)
+        if t != DNF:
+            solves += 1
+            total += t
+            delta = t - running
+            running += delta/solves
+            deviations += delta*(t - running)
+
+    # each size needs its own tree: the trimmed ends of the last k solves can't be read off a larger window's tree
+    averages = []
+    for name, k, trim in AVERAGES:
+        current, best = None, DNF
+        for avg in rolling(session, k, trim):
+            current, best = avg, min(best, avg)
+        if current is not None:
+            averages.append((name, current, best))
+
+    # DNFs sort last
+    sorted_solves = np.sort(np.asarray(session))[:solves] if np is not None else sorted(t for t in session if t != DNF)
+    count, n = len(session), solves
+    return {"count": count,
+            "solves": n,
+            "dnfs": count - n,
+            "dnf_rate": round(100*(count - n)/count, 2) if count > 0 else 0,
+            "best": float(sorted_solves[0]) if n > 0 else DNF,
+            "worst": float(sorted_solves[-1]) if n > 0 else DNF,
+            "mean": round(total/n, 2) if n > 0 else DNF,
+            "std": round(math.sqrt(deviations/n), 2) if n > 0 else DNF,
+            "percentiles": {q: percentile(sorted_solves, q) for q in PERCENTILES} if n > 0 else {},
+            "averages": averages,
+            # non-rolling ao5s
+            "blocks": process(session) if count >= 5 else None,
+           }
 
-def parse_cstimer_text(text: str) -> list:
-    """ Parses csTimer text. """
-    return [parse_time(line.split()[1]) for line in text.split("\n")[4:]]
+def read_lines(f) -> iter:
+    """ Yields the lines of a string or a (text or binary) file without reading it all at once. """
+    for line in (io.StringIO(f) if isinstance(f, str) else f):
+        yield (line.decode("utf-8", "replace") if isinstance(line, bytes) else line).rstrip("\r\n")
 
-def parse_dctimer_text(text: str) -> list:
-    """ Parses DCTimer text. """
-    i = None
-    for j, line in enumerate(text.split("\n")):
+def parse_csv(lines: iter, header: str) -> iter:
+    """ Parses the rest of a csTimer CSV file. """
+    column = header.split(";").index("Time")
+    for row in csv.reader(lines, delimiter=";"):
+        try:
+            yield parse_time(row[column])
+        except (IndexError, ValueError):
+            continue
+
+def parse_cstimer(lines: iter, header: str) -> iter:
+    """ Parses the rest of a csTimer text export. """
+    # summary lines before the time list
+    for _ in range(3):
+        next(lines, None)
+    for line in lines:
+        try:
+            yield parse_time(line.split()[1])
+        except (IndexError, ValueError):
+            continue
+
+def parse_dctimer(lines: iter, header: str) -> iter:
+    """ Parses the rest of a DCTimer text export, whose times are all on one line. """
+    for line in itertools.chain([header], lines):
         if "," in line:
-            i = j
-            break
-    if i is None:
-        return []
-    return list(map(parse_time, text.split("\n")[i].split(":")[-1].split(", ")))
+            for token in line.split(":")[-1].split(", "):
+                try:
+                    yield parse_time(token.strip())
+                except (IndexError, ValueError):
+                    continue
+            return
+
+PARSERS = {"csTimer": parse_cstimer,
+           "DCTimer": parse_dctimer,
+          }
+
+def parse_stream(f) -> iter:
+    """ Recognizes the timer from the header and yields its times one at a time. """
+    lines = read_lines(f)
+    header = next((line for line in lines if line.strip() != ""), "")
+    if ";" in header:
+        parser = parse_csv
+    else:
+        tokens = header.split()
+        parser = PARSERS.get(tokens[2] if len(tokens) > 2 else None)
+    if parser is not None:
+        yield from parser(lines, header)
+
+def parse(f) -> list:
+    """ Parses a csTimer CSV file. """
+    return list(parse_stream(f))
 
 def parse_text(text: str) -> list:
     """ Parses a text file. """
-    try:
-        mode = text.split()[2]
-        parsers = {"csTimer": parse_cstimer_text,
-                   "DCTimer": parse_dctimer_text,
-                  }
-        return parsers[mode](text.strip())
-    except:
-        return []
-
+    return list(parse_stream(text))
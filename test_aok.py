@@ -0,0 +1,41 @@
+# Checks aok's rolling averages against the plain definition in statistics
+import random
+import pytest
+import aok
+import statistics as stats
+
+def session(rng: random.Random, n: int) -> list:
+    """ Random times with DNFs, and few enough distinct values that trims and roundings tie. """
+    digits = rng.choice([0, 1, 2, 3])
+    return [stats.DNF if rng.random() < 0.1 else round(rng.uniform(0.005, 30), digits) for _ in range(n)]
+
+def reference(times: list, k: int, trim: float) -> list:
+    return list(map(lambda l: stats.ao(l, trim), stats.block(times, k, roll=True)))
+
+def outcome(f, *args):
+    """ The result of f, or the type of error it raised. """
+    try:
+        return f(*args)
+    except ZeroDivisionError as e:
+        return type(e)
+
+@pytest.mark.parametrize("seed", range(200))
+def test_avgs(seed: int) -> None:
+    rng = random.Random(seed)
+    k, trim = rng.choice([1, 2, 3, 5, 12, 50, 100]), rng.choice([0, 0.05, 0.1, 0.2, 0.25])
+    times = session(rng, rng.randint(1, 3*k + 10))
+    assert outcome(aok.avgs, times, k, trim) == outcome(reference, times, k, trim)
+
+@pytest.mark.parametrize("seed", range(100))
+def test_aos(seed: int) -> None:
+    rng = random.Random(seed)
+    k, trim = rng.choice([3, 5, 12, 50]), rng.choice([0.05, 0.1, 0.2])
+    times = session(rng, rng.randint(k, 3*k + 10))
+    assert stats.aos(times, k, roll=True, p=trim) == reference(times, k, trim)
+    assert stats.aos(times, k, p=trim) == list(map(lambda l: stats.ao(l, trim), stats.block(times, k)))
+
+def test_ties() -> None:
+    # halves which float division rounds the wrong way, where avg falls back to mean
+    times = [1.005, 0.015, 2.675, 1.115, 0.125]*20
+    for k in (3, 5, 12):
+        assert aok.avgs(times, k) == reference(times, k, 0.05)
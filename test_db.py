@@ -0,0 +1,65 @@
+# Checks that concurrent updates of a document through either backend are never lost or seen half written
+import os, multiprocessing
+import pytest
+import db
+
+PROCESSES, UPDATES = 8, 50
+
+def where(kind: str, folder) -> str:
+    return str(folder) + "/" if kind == "json" else str(folder / "stress.db")
+
+def hammer(kind: str, path: str) -> None:
+    """ Updates the document over and over. """
+    store, pid = db.BACKENDS[kind](path), str(os.getpid())
+    for i in range(UPDATES):
+        with store.transaction("stress") as obj:
+            obj["count"] += 1
+            obj["pids"][pid] = obj["pids"].get(pid, 0) + 1
+        store.set(i, "stress", "last")
+
+def watch(kind: str, path: str, stop) -> None:
+    """ Reads the document until stopped, failing on a partial write. """
+    store = db.BACKENDS[kind](path)
+    while not stop.is_set():
+        store.load("stress")["count"]
+
+@pytest.mark.parametrize("kind", db.BACKENDS)
+def test_stress(tmp_path, kind: str) -> None:
+    path = where(kind, tmp_path)
+    db.BACKENDS[kind](path).dump({"count": 0, "pids": {}, "last": None}, "stress")
+    stop = multiprocessing.Event()
+    reader = multiprocessing.Process(target=watch, args=(kind, path, stop))
+    writers = [multiprocessing.Process(target=hammer, args=(kind, path)) for _ in range(PROCESSES)]
+    reader.start()
+    for p in writers:
+        p.start()
+    for p in writers:
+        p.join()
+    stop.set()
+    reader.join()
+
+    assert all(p.exitcode == 0 for p in writers), "a writer failed"
+    assert reader.exitcode == 0, "a reader saw a partial write"
+    obj = db.BACKENDS[kind](path).load("stress")
+    assert obj["count"] == sum(obj["pids"].values()) == PROCESSES*UPDATES
+    assert obj["last"] == UPDATES - 1
+
+def test_mode(tmp_path) -> None:
+    store = db.File(str(tmp_path) + "/")
+    store.dump({"hash": "secret"}, "users")
+    os.chmod(store.path("users"), 0o600)
+    with store.transaction("users") as users:
+        users["totp"] = "secret"
+    assert os.stat(store.path("users")).st_mode & 0o777 == 0o600
+
+def test_pool(tmp_path) -> None:
+    store, opened = db.Database(str(tmp_path / "cube.db")), []
+    store.open = lambda open=store.open: opened.append(1) or open()
+    store.dump({"alice": {"keys": [1, True]}, "visits": 0}, "users")
+    for _ in range(20):
+        assert store.get("users", "alice", "keys", 1) is True
+        with store.transaction("users") as users:
+            users["visits"] += 1
+    assert store.load("users")["visits"] == 20
+    # every lookup and transaction borrowed the one connection the schema was created on
+    assert len(opened) == 1
@@ -0,0 +1,71 @@
+# Checks the shared time parser and the timer export readers
+import array, random, timeit
+import pytest
+import statistics as stats
+
+@pytest.mark.parametrize("s, t", [
+    ("12.34", 12.34), ("7", 7.0), (".5", 0.5), (" 9.80 ", 9.8),
+    ("1:02.34", 62.34), ("59:59.99", 3599.99), ("1:00:00", 3600.0), ("1:02:03.45", 3723.45),
+    ("12.34+", 12.34), ("1:02.34+", 62.34),
+    ("DNF", stats.DNF), ("DNS", stats.DNF), ("DNF(12.34)", stats.DNF),
+    ("(12.34)", 12.34), ("( 1:02.34 )", 62.34), ("(DNF)", stats.DNF),
+    ("3/4 58:12", 2), ("10/10", 10), ("2/3", 1),
+    ("", stats.DNF), ("   ", stats.DNF), ("()", stats.DNF),
+])
+def test_parse_time(s: str, t: float) -> None:
+    assert stats.parse_time(s) == t
+
+def test_digits() -> None:
+    assert stats.parse_time("12.346", 2) == 12.35
+    assert stats.parse_time("1:02.3456", 2) == 62.35
+    assert stats.parse_time("12.3456+", 1) == 12.3
+
+@pytest.mark.parametrize("s", ["abc", "1:2:3:4", "12.34.56", "inf", "nan"])
+def test_invalid(s: str) -> None:
+    with pytest.raises(ValueError):
+        stats.parse_time(s)
+
+def test_parse_many() -> None:
+    times = stats.parse_many(["12.34", "(9.80)", "DNF", "1:02.34+", "", "3/4 58:12"])
+    assert isinstance(times, array.array) and times.typecode == "d"
+    assert list(times) == [12.34, 9.8, stats.DNF, 62.34, stats.DNF, 2]
+    assert list(stats.parse_many(["12.346", "1:00.004"], 2)) == [12.35, 60.0]
+    assert len(stats.parse_many([])) == 0
+
+def test_csv() -> None:
+    text = ("No.;Time;Comment;Scramble;Date;P.1\r\n"
+            "1;10.87;;R2 U F';2019-06-28 10:00:00;10.87\r\n"
+            "2;DNF(9.46);;U2 R;2019-06-28 10:01:00;9.46\r\n"
+            "3;1:02.34+;;F R;2019-06-28 10:02:00;60.34\r\n")
+    assert stats.parse(text) == [10.87, stats.DNF, 62.34]
+    # uploads come in as binary files
+    assert stats.parse(text.encode().splitlines(keepends=True)) == [10.87, stats.DNF, 62.34]
+
+def test_cstimer() -> None:
+    text = ("Generated By csTimer on 2019-06-28\n"
+            "mean of 3: 11.04\n"
+            "\n"
+            "Time List:\n"
+            "1. 10.87   R2 U F'\n"
+            "2. (9.46)   U2 R\n"
+            "3. DNF(12.79)   F R\n"
+            "4. 12.80+   B L\n")
+    assert stats.parse_text(text) == [10.87, 9.46, stats.DNF, 12.8]
+
+def test_dctimer() -> None:
+    text = ("Generated By DCTimer on 2019-06-28\n"
+            "Average: 11.04\n"
+            "Times: 10.87, (9.46), DNF, 12.80+\n")
+    assert stats.parse_text(text) == [10.87, 9.46, stats.DNF, 12.8]
+
+def test_unknown() -> None:
+    assert stats.parse_text("") == []
+    assert stats.parse_text("some notes\nabout solves\n") == []
+
+def test_benchmark() -> None:
+    """ Micro-benchmark of the time parser, run with -s to see the rate. """
+    n, rng = 10**5, random.Random(0)
+    formats = ["{:.2f}", "({:.2f})", "{:.2f}+", "1:{:05.2f}", "DNF({:.2f})"]
+    l = [rng.choice(formats).format(rng.uniform(5, 30)) for _ in range(n)]
+    assert list(stats.parse_many(l)) == [stats.parse_time(s) for s in l]
+    print(f"parse_many: {n/min(timeit.repeat(lambda: stats.parse_many(l), number=1, repeat=5)):.0f} times/s")
@@ -0,0 +1,101 @@
+# Checks the WCA index against scoring a synthetic export one result at a time
+import os, random
+import numpy as np
+import pytest
+import wca
+
+EVENTS = ["333", "222", "444", "555", "666", "777", "333bf", "333fm", "333oh", "clock", "minx", "pyram", "skewb", "sq1",
+          "444bf", "555bf", "333mbf", "333ft", "magic", "mmagic"]
+COUNTRIES = ["USA", "China", "Poland", "Canada", "Australia"]
+
+def export(persons: dict, results: dict) -> None:
+    """ Writes a synthetic export, given the country of each person and each (mode, event)'s bests. """
+    folder = "WCA_export/WCA_export_"
+    with open(folder + "Events.tsv", "w") as f:
+        f.write("id\tname\trank\tformat\tcellName\n")
+        f.writelines("{0}\t{0}\t{1}\ttime\t{0}\n".format(e, 10*(i + 1)) for i, e in enumerate(EVENTS))
+    with open(folder + "Persons.tsv", "w", encoding="utf-8") as f:
+        f.write("id\tsubid\tname\tcountryId\tgender\n")
+        f.writelines("{}\t1\tPérson {}\t{}\tm\n".format(p, p, country) for p, country in persons.items())
+    for mode in wca.modes:
+        with open(folder + "Ranks{}.tsv".format(mode), "w") as f:
+            f.write("personId\teventId\tbest\tworldRank\tcontinentRank\tcountryRank\n")
+            for (m, e), bests in results.items():
+                if m != mode:
+                    continue
+                people, rank = sorted(bests, key=bests.get), 0
+                for j, p in enumerate(people):
+                    # ties share the rank of the first of them
+                    if j == 0 or bests[p] != bests[people[j - 1]]:
+                        rank = j + 1
+                    f.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(p, e, bests[p], rank, rank, rank))
+
+def best(rng: random.Random, event: str) -> int:
+    if event == "333mbf":
+        return int("{:02d}{:05d}{:02d}".format(99 - rng.randint(2, 40), rng.randint(600, 3600), rng.randint(0, 5)))
+    # few enough values that there are ties
+    return rng.randint(100, 2000)
+
+def mutate(rng: random.Random, persons: dict, results: dict) -> None:
+    """ Removes and adds persons, and improves and adds results, sometimes breaking a world record. """
+    for p in rng.sample(sorted(persons), 3):
+        del persons[p]
+        for bests in results.values():
+            bests.pop(p, None)
+    for i in range(10):
+        persons["2099N{:02d}{:03d}".format(rng.randrange(100), i)] = rng.choice(COUNTRIES)
+    for (mode, e), bests in results.items():
+        for p in rng.sample(sorted(bests), min(len(bests), rng.randint(0, 3))):
+            bests[p] = bests[p] - 10**7 if e == "333mbf" else max(bests[p] - rng.randint(0, 1500), 1)
+        new = [p for p in sorted(persons) if p not in bests]
+        for p in rng.sample(new, min(len(new), rng.randint(0, 4))):
+            bests[p] = rng.choice(list(bests.values()))
+
+def reference(persons: dict, results: dict) -> dict:
+    """ Scores every person in plain Python, the way the index should. """
+    people, scored = list(persons), EVENTS[:17]
+    sor = {mode: np.zeros((len(people), len(scored)), dtype=np.int32) for mode in wca.modes}
+    kinch = {mode: np.zeros((len(people), len(scored))) for mode in wca.modes}
+    value = lambda e, b: wca.parse_mbld(str(b)) if e == "333mbf" else b
+    for (mode, e), bests in results.items():
+        j, record = scored.index(e), min(bests.values())
+        ordered = sorted(bests.values())
+        for p, b in bests.items():
+            i = people.index(p)
+            sor[mode][i, j] = ordered.index(b) + 1
+            kinch[mode][i, j] = 100*(value(e, b)/value(e, record) if e == "333mbf" else record/b)
+        # a missing result ranks after everyone with one, except the mbld average which has no results
+        sor[mode][sor[mode][:, j] == 0, j] = ordered.index(ordered[-1]) + 2
+    j = scored.index("333mbf")
+    kinch["Average"][:, j] = kinch["Single"][:, j]
+    for e in ("333bf", "333fm", "444bf", "555bf"):
+        j = scored.index(e)
+        kinch["Average"][:, j] = np.maximum(kinch["Single"][:, j], kinch["Average"][:, j])
+    return {"sor": sor, "kinch": kinch}
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ingest(tmp_path, monkeypatch, seed: int) -> None:
+    monkeypatch.chdir(tmp_path)
+    wca.find_folder.cache_clear()
+    os.makedirs("WCA_export")
+    rng = random.Random(seed)
+    persons = {"20{:02d}P{:04d}".format(i % 20, i): rng.choice(COUNTRIES) for i in range(300)}
+    results = {}
+    for mode in wca.modes:
+        for e in EVENTS[:17]:
+            if mode == "Average" and e == "333mbf":
+                continue
+            results[mode, e] = {p: best(rng, e) for p in rng.sample(sorted(persons), rng.randint(30, 150))}
+    # ingesting a changed export again mustn't keep anything from the first one
+    for step in range(2):
+        export(persons, results)
+        wca.ingest()
+        wca.load()
+        expected = reference(persons, results)
+        assert [bytes(i).decode() for i in wca.ids] == list(persons)
+        for mode in wca.modes:
+            assert np.array_equal(wca.sor_scores[mode], expected["sor"][mode]), (step, mode)
+            np.testing.assert_allclose(wca.kinch_scores[mode], expected["kinch"][mode], rtol=1e-12)
+            assert np.array_equal(wca.sor_sums[mode], expected["sor"][mode].sum(axis=1))
+        np.testing.assert_allclose(wca.kinch_means, expected["kinch"]["Average"].mean(axis=1), rtol=1e-12)
+        mutate(rng, persons, results)
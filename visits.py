@@ -0,0 +1,115 @@
+# Counts page visits
+# Each worker adds visits up in memory and every so often appends them to a log for the day.
+# Once a day is over its logs are rolled up into one document, so no write grows with the history.
+import os, glob, json, time, fcntl, atexit, threading, collections
+from datetime import datetime
+import db
+
+FOLDER = db.FILES + "vists/"
+# seconds between writes
+INTERVAL = 60
+# how days are named on disk, and how they're shown (same as dates.unix_to_date)
+DAY, DATE = "%Y-%m-%d", "%m/%d/%Y"
+
+store = db.File(FOLDER)
+counts, lock, flushed = collections.defaultdict(collections.Counter), threading.Lock(), time.time()
+
+def day(t: float) -> str:
+    return datetime.fromtimestamp(t).strftime(DAY)
+
+def count(path: str) -> bool:
+    """ Counts a visit to a page. Returns whether a day was rolled up. """
+    with lock:
+        counts[day(time.time())][path] += 1
+    return flush() if time.time() - flushed > INTERVAL else False
+
+def append(fname: str, line: str) -> None:
+    """ Appends a line to a log, unless it's being rolled up. """
+    while True:
+        with open(fname, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # the log was rolled up while waiting for the lock, so start a new one
+            if os.fstat(f.fileno()).st_nlink == 0:
+                continue
+            f.write(line)
+            return
+
+def flush() -> bool:
+    """ Writes out the counts in memory. Returns whether a day was rolled up. """
+    global counts, flushed
+    with lock:
+        pending, counts, flushed = counts, collections.defaultdict(collections.Counter), time.time()
+    if len(pending) == 0:
+        return False
+    if not os.path.isdir(FOLDER):
+        migrate()
+    for d, paths in pending.items():
+        append(FOLDER + d + ".log", json.dumps(paths, sort_keys=True) + "\n")
+    return rollup()
+
+def rollup() -> bool:
+    """ Rolls the logs of past days up into one document per day. """
+    today, rolled = day(time.time()), False
+    logs = [fname for fname in sorted(glob.glob(FOLDER + "*.log")) if os.path.basename(fname)[:-len(".log")] < today]
+    if len(logs) == 0:
+        return False
+    with store.lock("rollup"):
+        for fname in logs:
+            d = os.path.basename(fname)[:-len(".log")]
+            try:
+                f = open(fname)
+            except FileNotFoundError:
+                # another worker got to it first
+                continue
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue
+                # a worker which was idle past midnight can add to a day which is already rolled up
+                total = collections.Counter(store.load(d) if os.path.exists(store.path(d)) else {})
+                for line in f:
+                    total.update(json.loads(line))
+                store.write(dict(total), d)
+                os.remove(fname)
+            rolled = True
+    return rolled
+
+def migrate() -> None:
+    """ Splits the old vists document into rollups. """
+    os.makedirs(FOLDER, exist_ok=True)
+    with store.lock("rollup"):
+        if len(glob.glob(FOLDER + "*.json")) > 0:
+            return
+        try:
+            old = db.storage("vists").load("vists")
+        except FileNotFoundError:
+            return
+        days = collections.defaultdict(dict)
+        for path, dates in old.items():
+            # when the heatmap was last drawn
+            if path == "time":
+                continue
+            for date, n in dates.items():
+                days[datetime.strptime(date, DATE).strftime(DAY)][path] = n
+        for d, paths in days.items():
+            store.write(paths, d)
+
+def load() -> dict:
+    """ Returns the number of visits to each page on each day, including the ones not rolled up yet. """
+    vists = collections.defaultdict(collections.Counter)
+    for fname in sorted(glob.glob(FOLDER + "*.json")) + sorted(glob.glob(FOLDER + "*.log")):
+        d, ext = os.path.splitext(os.path.basename(fname))
+        date = datetime.strptime(d, DAY).strftime(DATE)
+        with open(fname) as f:
+            for paths in [json.load(f)] if ext == ".json" else map(json.loads, f):
+                for path, n in paths.items():
+                    vists[path][date] += n
+    # and the ones still in memory
+    with lock:
+        for d, paths in counts.items():
+            for path, n in paths.items():
+                vists[path][datetime.strptime(d, DAY).strftime(DATE)] += n
+    return {path: dict(dates) for path, dates in vists.items()}
+
+# don't lose the visits since the last write when the worker stops
+atexit.register(flush)
@@ -1,124 +1,520 @@
-import os, sys, json
+import os, json, fcntl, argparse, threading, functools, concurrent.futures
+import numpy as np
 
 # Parses the WCA export files
 # TODO: autodownload latest WCA export
 
+# The export is ingested offline (python wca.py ingest, run by the wca script) into a
+# columnar index of NumPy arrays, which the web workers only memory-map.
+INDEX = "files/wca/index/"
+SOURCES = ["Persons", "Events", "RanksSingle", "RanksAverage"]
+# bumped whenever the layout of the index changes
+VERSION = 3
+# serializes ingesting between processes, e.g. a refresh started twice
+LOCK = "files/wca/index.lock"
+# the Ranks files are parsed in chunks of about this many bytes, one process per core
+CHUNK = 1 << 23
+PROCESSES = os.cpu_count() or 1
+
+@functools.lru_cache(maxsize=1)
+def find_folder(mtime: float) -> str:
+    """ Finds the folder of the WCA export, given the modification time of the working directory. """
+    prefix = "WCA_export"
+    folders = [x for x in os.listdir() if x[:len(prefix)] == prefix]
+    if len(folders) == 0:
+        raise FileNotFoundError("no WCA export in " + os.getcwd())
+    return folders[0]
+
+def wca_folder() -> str:
+    """ Returns the folder of the WCA export. """
+    # only list the directory again once an entry was added or removed
+    return find_folder(os.stat(".").st_mtime)
+
+def wca_path(fname: str) -> str:
+    """ Returns the path of a file from the WCA export. """
+    prefix = "WCA_export"
+    return "{}/{}_{}.tsv".format(wca_folder(), prefix, fname)
+
 def wca_open(fname: str):
     """ Opens a file from the WCA export. """
-    prefix = "WCA_export"
-    folder = [x for x in os.listdir() if x[:len(prefix)] == prefix][0]
-    return open("{}/{}_{}.tsv".format(folder, prefix, fname))
+    return open(wca_path(fname), encoding="utf-8")
 
-def parse(fname: str) -> list:
+def parse(fname: str, columns: tuple=(0, 2)) -> list:
     """ Parses a file. """
     with wca_open(fname) as f:
         f.readline() #skip header
-        return [(line.split("\t")[0], line.split("\t")[2]) for line in f]
+        return [tuple(line.rstrip("\n").split("\t")[i] for i in columns) for line in f]
+
+def wca_map(path: str, start: int=0, end: int=None) -> np.ndarray:
+    """ Memory-maps a byte range of a file as an array of bytes. """
+    end = os.path.getsize(path) if end is None else end
+    if end <= start:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r", offset=start, shape=(end - start,))
 
-def parse_mbld(s: str) -> float:
-    """ Turns the WCA multiblind format into a number. """
-    diff, time = 99 - int(s[0:2]), int(s[2:7])/60
-    return diff + max((60 - time)/60, 0)
+def header(path: str) -> tuple:
+    """ Returns the column names of a TSV file and the offset of its first row. """
+    with open(path, "rb") as f:
+        line = f.readline()
+    return line.rstrip(b"\r\n").decode().split("\t"), len(line)
 
-def sor(**kwargs: dict) -> int:
+def scan(buf: np.ndarray, fields: int) -> tuple:
+    """ Returns the start and end of every field of every line, as two lines x fields arrays. """
+    seps = np.flatnonzero((buf == ord("\t")) | (buf == ord("\n")))
+    if len(buf) > 0 and buf[-1] != ord("\n"):
+        seps = np.append(seps, len(buf))
+    if len(seps) % fields != 0:
+        raise ValueError("every line needs {} fields".format(fields))
+    ends = seps.reshape(-1, fields)
+    starts = np.empty_like(ends)
+    starts[:, 1:] = ends[:, :-1] + 1
+    starts[1:, 0], starts[:1, 0] = ends[:-1, -1] + 1, 0
+    # CRLF line endings
+    last = ends[:, -1]
+    last -= (last > starts[:, -1]) & (buf[np.maximum(last - 1, 0)] == ord("\r"))
+    return starts, ends
+
+def column(buf: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """ Copies a field of every line into a fixed width bytes array. """
+    width = int((end - start).max(initial=1))
+    out = np.zeros((len(start), width), dtype=np.uint8)
+    # one byte position at a time, so the temporaries are a single column
+    for k in range(width):
+        i = start + k
+        out[:, k] = np.where(i < end, buf[np.minimum(i, len(buf) - 1)], 0)
+    return out.view("S{}".format(width)).reshape(-1)
+
+def integers(buf: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """ Parses a field of decimal digits on every line. """
+    out = np.zeros(len(start), dtype=np.int64)
+    for k in range(int((end - start).max(initial=0))):
+        i = end - 1 - k
+        out += np.where(i >= start, buf[np.maximum(i, 0)].astype(np.int64) - ord("0"), 0)*10**k
+    return out
+
+def pieces(buf: np.ndarray, start: np.ndarray, end: np.ndarray) -> tuple:
+    """ Joins a variable length field of every line into one buffer, returns it and the offset of each field. """
+    lengths = end - start
+    offsets = np.append(0, np.cumsum(lengths))
+    return buf[np.repeat(start - offsets[:-1], lengths) + np.arange(offsets[-1])], offsets
+
+def read_persons() -> dict:
+    """ Reads the id, name and country of every person straight from the mapped Persons file. """
+    path = wca_path("Persons")
+    names, offset = header(path)
+    buf = wca_map(path, offset)
+    starts, ends = scan(buf, len(names))
+    field = lambda i: (starts[:, i], ends[:, i])
+    # id, subid, name, countryId
+    wca_ids = column(buf, *field(0))
+    # a person with several subids is listed where it first appears, with the values of its last line
+    unique, first = np.unique(wca_ids, return_index=True)
+    last = len(wca_ids) - 1 - np.unique(wca_ids[::-1], return_index=True)[1]
+    order = np.argsort(first)
+    first, last = first[order], last[order]
+    start, end = field(2)
+    name_buffer, name_offsets = pieces(buf, start[last], end[last])
+    countries, codes = np.unique(column(buf, *field(3))[last], return_inverse=True)
+    return {"ids": wca_ids[first].astype("S10"), "names": name_buffer, "name_offsets": name_offsets,
+            "countries": codes.reshape(-1).astype(np.int16), "country_names": [c.decode() for c in countries]}
+
+def parse_mbld(s) -> float:
+    """ Turns the WCA multiblind format into a number, for one result or an array of them. """
+    s = int(s) if isinstance(s, str) else np.asarray(s, dtype=np.int64)
+    # DDTTTTTMM: 99 minus the points, then the time in seconds
+    diff, time = 99 - s//10**7, s//100 % 10**5/60
+    return diff + np.maximum((60 - time)/60, 0)
+
+# metrics take whole columns of a Ranks file and return one score per row
+def sor(**kwargs: dict) -> np.ndarray:
     """ Defines a metric. """
     return kwargs["rank"]
 
 def kinch(**kwargs):
-    mode, event, sing = kwargs["mode"], kwargs["event"], kwargs["sing"]
-    return 100*(wrd[mode][event]/sing if event != "333mbf" else sing/wrd[mode][event])
+    event, sing, wr = kwargs["event"], kwargs["sing"], kwargs["wr"]
+    with np.errstate(divide="ignore"):
+        return 100*np.where(event == "333mbf", sing/wr, wr/sing)
 
-def find_scores(metric: str) -> dict:
-    """ Finds the score dictionary of WCA id : score """
-    # remove mbld event from average
-    scores = {p: {"Single": {event: 0 for event in events}, "Average": {event: 0 for event in events[:-1]}} for p in persons}
+def split(path: str, size: int=CHUNK) -> list:
+    """ Splits a file after its header into byte ranges of whole lines. """
+    with open(path, "rb") as f:
+        start, end = len(f.readline()), os.path.getsize(path)
+        bounds = [start]
+        while bounds[-1] < end:
+            f.seek(min(bounds[-1] + size, end))
+            f.readline()
+            bounds.append(min(f.tell(), end))
+    return list(zip(bounds[:-1], bounds[1:])) or [(start, end)]
 
+def parse_chunk(path: str, start: int, end: int) -> tuple:
+    """ Parses the person, event, best and rank of the rows in a byte range of a Ranks file. """
+    names = header(path)[0]
+    buf = wca_map(path, start, end)
+    starts, ends = scan(buf, len(names))
+    field = lambda i: (starts[:, i], ends[:, i])
+    # personId, eventId, best, worldRank
+    return (column(buf, *field(0)).astype("S10"), column(buf, *field(1)),
+            integers(buf, *field(2)), integers(buf, *field(3)).astype(np.int32))
+
+def lookup(ids: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """ Returns the position of each key in ids, -1 if it isn't there. """
+    if len(ids) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    order = np.argsort(ids, kind="stable")
+    # bisecting a sorted copy is much faster than going through the sorter
+    i = order[np.minimum(np.searchsorted(ids[order], keys), len(ids) - 1)]
+    return np.where(ids[i] == keys, i, -1)
+
+def read_ranks(ids: np.ndarray) -> dict:
+    """ Reads the Ranks files into columns, parsing chunks of them in parallel. """
+    jobs = [(mode, wca_path("Ranks" + mode)) for mode in modes]
+    jobs = [(mode, path, start, end) for mode, path in jobs for start, end in split(path)]
+    if PROCESSES > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(PROCESSES, len(jobs))) as pool:
+            parts = list(pool.map(parse_chunk, *list(zip(*jobs))[1:]))
+    else:
+        parts = [parse_chunk(*job[1:]) for job in jobs]
+
+    ranks = {}
     for mode in modes:
-        with wca_open("Ranks" + mode) as f:
-            f.readline()
-            cevent, crank = "", 0
-            for line in f:
-                line = line.split("\t")
-                person, event, sing, rank = line[:4]
-                rank, sing = int(rank), int(sing) if event != "333mbf" else parse_mbld(sing)
-                if event != cevent:
-                    wrd[mode][event], rankd[mode][cevent], cevent = sing, crank, event
-                crank, scores[person][mode][event] = rank, funcs[metric](mode=mode, rank=rank, sing=sing, event=event)
-        rankd[mode][event] = rank
-        del rankd[mode][""]
+        # the chunks are joined in file order, so each event is still one block of rows
+        person, event, best, rank = map(np.concatenate, zip(*[part for job, part in zip(jobs, parts) if job[0] == mode]))
+        rows = lookup(ids, person)
+        if (rows < 0).any():
+            raise KeyError(person[rows < 0][0].decode())
+        ranks[mode] = {"person": rows.astype(np.int32), "event": event, "column": event_index(event), "best": best, "rank": rank}
+    return ranks
+
+def event_index(event: np.ndarray) -> np.ndarray:
+    """ Returns the column of each event, -1 for events which aren't scored. """
+    # one lookup per block of equal events instead of sorting the whole column
+    start = np.ones(len(event), dtype=bool)
+    start[1:] = event[1:] != event[:-1]
+    lookup = np.array([events.index(e) if e in events else -1 for e in event[start].astype(str)], dtype=np.int16)
+    return lookup[np.cumsum(start) - 1]
+
+def filled(mode: str) -> list:
+    """ Returns the events of a mode, without the mbld average. """
+    return events if mode == "Single" else events[:-1]
 
+def find_records(mode: str, columns: dict) -> tuple:
+    """ Records the world record and competitors of each event, returns the result and world record of each row. """
+    event, rank = columns["event"], columns["rank"]
+    mbf = event == b"333mbf"
+    sing = columns["best"].astype(np.float64)
+    sing[mbf] = parse_mbld(columns["best"][mbf])
+
+    # the file is sorted by event, so the first row of each block is the record and the last one the most competitors
+    start = np.ones(len(event), dtype=bool)
+    start[1:] = event[1:] != event[:-1]
+    first = np.flatnonzero(start)
+    last = np.append(first[1:], len(event)) - 1
+    for i, j in zip(first, last):
+        wrd[mode][event[i].decode()] = float(sing[i]) if mbf[i] else int(columns["best"][i])
+        rankd[mode][event[i].decode()] = int(rank[j])
+
+    return sing, sing[first][np.cumsum(start) - 1]
+
+def score_rows(metric: str, mode: str, columns: dict, rows=slice(None)) -> np.ndarray:
+    """ Scores rows of a Ranks file. """
+    sing, wr = find_records(mode, columns)
+    return funcs[metric](mode=mode, rank=columns["rank"][rows], sing=sing[rows], event=columns["event"][rows].astype(str), wr=wr[rows])
+
+def adjust(metric: str, scores: dict) -> None:
+    """ Fills in the scores of missing results. """
     if metric == "sor":
-        # fill in empty result with the number of competitors plus one
-        for person in scores:
-            for mode in modes:
-                for event in scores[person][mode]:
-                    if scores[person][mode][event] == 0:
-                        scores[person][mode][event] = rankd[mode][event] + 1
+        # fill in empty result with the number of competitors plus one, except for the mbld average
+        for mode in modes:
+            for j, event in enumerate(filled(mode)):
+                scores[mode][scores[mode][:, j] == 0, j] = rankd[mode][event] + 1
     else:
         # events which don't have an average, replace with single
         navg = ["333mbf"]
         for event in navg:
             wrd["Average"][event] = wrd["Single"][event]
-        for person in scores:
-            for event in navg:
-                scores[person]["Average"][event] = scores[person]["Single"][event]
+            j = events.index(event)
+            scores["Average"][:, j] = scores["Single"][:, j]
 
         # events which take the better between single and average
         better = ["333bf", "333fm", "444bf", "555bf"]
-        for person in scores:
-            for event in better:
-                scores[person]["Average"][event] = max(scores[person]["Single"][event], scores[person]["Average"][event])
+        for event in better:
+            j = events.index(event)
+            scores["Average"][:, j] = np.maximum(scores["Single"][:, j], scores["Average"][:, j])
 
+def find_scores(metric: str, ranks: dict, dtype=np.float64) -> dict:
+    """ Finds the person x event score matrix of each mode. """
+    scores = {}
+    for mode in modes:
+        columns = ranks[mode]
+        score = score_rows(metric, mode, columns)
+        matrix, column = np.zeros((len(persons), len(events)), dtype=dtype), columns["column"]
+        known = column >= 0
+        matrix[columns["person"][known], column[known]] = score[known]
+        scores[mode] = matrix
+    adjust(metric, scores)
     return scores
 
-def sum_scores(scores: dict, name: str, mode: str="Single", avg: bool=False):
-    return sum(scores[name][mode].values())/(len(events) if avg else 1)
+def export_mtime() -> float:
+    """ Returns the last modification time of the export files. """
+    return max(os.path.getmtime(wca_path(fname)) for fname in SOURCES)
+
+def read_export() -> tuple:
+    """ Reads the events, people and Ranks files of the export. """
+    global events, persons
+    events = [x[0] for x in sorted(parse("Events"), key=lambda x: int(x[1]))[:-3]]
+    people = read_persons()
+    persons = people["ids"]
+    for mode in modes:
+        wrd[mode].clear(), rankd[mode].clear()
+    return people, read_ranks(persons)
+
+def ingest() -> None:
+    """ Parses the WCA export and writes the columnar index. """
+    people, ranks = read_export()
+    save_index(people, ranks, find_scores("sor", ranks, np.int32), find_scores("kinch", ranks, np.float64))
+
+def save_index(people: dict, ranks: dict, sor_scores: dict, kinch_scores: dict) -> None:
+    """ Writes the columnar index. """
+    os.makedirs(INDEX, exist_ok=True)
+    save = lambda name, array: write(INDEX + name + ".npy", lambda f: np.save(f, array))
+    wca_ids = people["ids"]
+    save("ids", wca_ids)
+    # for finding a person by WCA id with bisection
+    order = np.argsort(wca_ids, kind="stable")
+    save("sorted_ids", wca_ids[order])
+    save("id_order", order.astype(np.int32))
+    # names are variable length: one UTF-8 buffer and the offset of each name
+    save("names", people["names"])
+    save("name_offsets", people["name_offsets"])
+    countries, codes = people["country_names"], people["countries"]
+    save("countries", codes)
+    # the persons of each country are a slice of country_order
+    save("country_order", np.argsort(codes, kind="stable").astype(np.int32))
+    save("country_offsets", np.cumsum(np.append(0, np.bincount(codes, minlength=len(countries))), dtype=np.int64))
+
+    for mode in modes:
+        columns = ranks[mode]
+        save(mode + "_person", columns["person"])
+        save(mode + "_event", columns["column"])
+        save(mode + "_best", columns["best"])
+        save(mode + "_rank", columns["rank"])
+        sor_matrix, kinch_matrix = sor_scores[mode], kinch_scores[mode]
+        save("sor_" + mode, sor_matrix)
+        save("kinch_" + mode, kinch_matrix)
+        # totals of each person, and sorted for ranking by bisection
+        sums = sor_matrix.sum(axis=1, dtype=np.int64)
+        save("sor_sum_" + mode, sums)
+        save("sor_total_" + mode, np.sort(sums))
+    means = kinch_scores["Average"].sum(axis=1)/len(events)
+    save("kinch_mean", means)
+    save("kinch_total", np.sort(means))
+
+    # meta.json goes last, so the index is only fresh once every array is written
+    write(INDEX + "meta.json", lambda f: f.write(json.dumps({"version": VERSION, "mtime": export_mtime(), "events": events,
+          "countries": countries, "wrs": wrd, "ranks": rankd}, indent=4, sort_keys=True).encode()))
+    write("files/wca/cache.json", lambda f: f.write(json.dumps({"wrs": wrd, "ranks": rankd}, indent=4, sort_keys=True).encode()))
+
+def write(path: str, dump) -> None:
+    """ Writes a file by replacing it, so processes mapping the old file keep a valid copy. """
+    with open(path + ".tmp", "wb") as f:
+        dump(f)
+    os.replace(path + ".tmp", path)
+
+def fresh() -> bool:
+    """ Whether the index exists and is at least as new as the export. """
+    try:
+        with open(INDEX + "meta.json") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    try:
+        return meta.get("version") == VERSION and meta["mtime"] >= export_mtime()
+    except FileNotFoundError:
+        # no export to compare against, so use whatever was ingested last
+        return meta.get("version") == VERSION
+
+def load() -> None:
+    """ Memory-maps the columnar index. """
+    global events, countries, ids, names, name_offsets, person_countries, sor_scores, kinch_scores, sor_totals, kinch_totals, \
+           sor_sums, kinch_means, sorted_ids, id_order, country_order, country_offsets
+    with open(INDEX + "meta.json") as f:
+        meta = json.load(f)
+    events, countries = meta["events"], meta["countries"]
+    for mode in modes:
+        wrd[mode], rankd[mode] = meta["wrs"][mode], meta["ranks"][mode]
+    mmap = lambda name: np.load(INDEX + name + ".npy", mmap_mode="r")
+    ids, names, name_offsets, person_countries = mmap("ids"), mmap("names"), mmap("name_offsets"), mmap("countries")
+    sor_scores = {mode: mmap("sor_" + mode) for mode in modes}
+    kinch_scores = {mode: mmap("kinch_" + mode) for mode in modes}
+    sor_totals, kinch_totals = {mode: mmap("sor_total_" + mode) for mode in modes}, mmap("kinch_total")
+    sor_sums, kinch_means = {mode: mmap("sor_sum_" + mode) for mode in modes}, mmap("kinch_mean")
+    sorted_ids, id_order = mmap("sorted_ids"), mmap("id_order")
+    country_order, country_offsets = mmap("country_order"), mmap("country_offsets")
+
+def refresh(full: bool=False) -> bool:
+    """ Ingests the export unless the index is up to date with it, or always if full. Returns whether it ingested. """
+    os.makedirs(os.path.dirname(LOCK), exist_ok=True)
+    with open(LOCK, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # another process may have ingested while we waited
+        if not full and fresh():
+            return False
+        ingest()
+        return True
+
+def init() -> None:
+    """ Maps the index, again whenever a new one is ingested. Raises FileNotFoundError if there isn't one. """
+    global loaded
+    # never ingests: that takes minutes and a pool of processes, which a request can't wait for
+    stat = os.stat(INDEX + "meta.json")
+    if loaded == stat.st_mtime_ns:
+        return
+    with lock:
+        if loaded == stat.st_mtime_ns:
+            return
+        with open(INDEX + "meta.json") as f:
+            if json.load(f).get("version") != VERSION:
+                raise FileNotFoundError("the WCA index is out of date, run python wca.py ingest --full")
+        # the arrays are memory-mapped, so workers on one host share them through the page cache
+        load()
+        loaded = stat.st_mtime_ns
+
+def available() -> bool:
+    """ Whether there is an index to query. """
+    try:
+        init()
+    except FileNotFoundError:
+        return False
+    return True
+
+def name(i: int) -> str:
+    """ Returns the name of the i-th person. """
+    return bytes(names[name_offsets[i]:name_offsets[i + 1]]).decode()
+
+def sum_scores(scores: dict, mode: str="Single", avg: bool=False) -> np.ndarray:
+    """ Returns the total score of every person. """
+    return scores[mode].sum(axis=1)/(len(events) if avg else 1)
+
+def leaders(totals: np.ndarray, n: int, reverse: bool=False) -> np.ndarray:
+    """ Returns the positions of the n best totals in order, by partial selection. """
+    keys = -totals if reverse else totals
+    n = min(n, len(keys))
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    # everything better than the n-th total, then the first of the ties with it
+    kth = np.partition(keys, n - 1)[n - 1]
+    best = np.flatnonzero(keys < kth)
+    best = np.append(best, np.flatnonzero(keys == kth)[:n - len(best)])
+    return best[np.lexsort((best, keys[best]))]
+
+def totals(metric: str="sor", mode: str="Single") -> np.ndarray:
+    """ Returns the total SoR or mean Kinch of every person. """
+    init()
+    return sor_sums[mode] if metric == "sor" else kinch_means
+
+def country_rows(country: str) -> np.ndarray:
+    """ Returns the rows of every person from a country. """
+    init()
+    i = countries.index(country)
+    return country_order[country_offsets[i]:country_offsets[i + 1]]
+
+def top(metric: str="sor", mode: str="Single", n: int=10, country: str=None) -> np.ndarray:
+    """ Returns the rows of the n best persons, in the world or in one country. """
+    scores = totals(metric, mode)
+    if country is None:
+        return leaders(scores, n, metric == "kinch")
+    rows = country_rows(country)
+    return rows[leaders(scores[rows], n, metric == "kinch")]
+
+def find(wca_id: str) -> int:
+    """ Returns the row of a person, None if not found. """
+    init()
+    key = wca_id.encode()
+    i = int(np.searchsorted(sorted_ids, key))
+    return int(id_order[i]) if i < len(sorted_ids) and sorted_ids[i] == key else None
+
+def breakdown(i: int, metric: str="sor", mode: str="Single") -> dict:
+    """ Returns a person's total and score in each event. """
+    init()
+    scores, header = (sor_scores[mode], filled(mode)) if metric == "sor" else (kinch_scores["Average"], events)
+    return {"id": ids[i].decode(), "name": name(i), "country": countries[person_countries[i]],
+            "total": totals(metric, mode)[i].item(), "scores": dict(zip(header, scores[i].tolist()))}
+
+def place(total: float, metric: str="sor", mode: str="Single", country: str=None) -> int:
+    """ Returns the place that a total would be, in the world or in one country. """
+    if country is None:
+        return sor_rank(total, mode) if metric == "sor" else kinch_rank(total)
+    scores = totals(metric, mode)[country_rows(country)]
+    return int(np.count_nonzero(scores > total if metric == "kinch" else scores < total)) + 1
 
 def display(metric: str, scores: dict, mode: str="Single", reverse: bool=False, l: int=10):
+    init()
     header = events[:-1] if metric == "sor" else events
+    columns = [events.index(event) for event in header]
 
-    ranking = sorted(list(persons), key=lambda x: sum_scores(scores, x, mode), reverse=reverse)
-    max_len = len(persons[max(ranking[:l], key=lambda x: len(persons[x]))])
+    totals = sum_scores(scores, mode, reverse)
+    ranking = leaders(totals, l, reverse)
+    max_len = max(len(name(i)) for i in ranking)
     print(" "*(len(str(l)) + 1) + "Name" + " "*max_len + "Score\t" + "\t".join(header))
-    for i in range(l):
-        name, id = persons[ranking[i]], ranking[i]
-        prefix = str(i + 1) + " "*(len(str(l)) - len(str(i + 1)) + 1) + name + " "*(max_len - len(name)) + "\t"
-        print(prefix + str(round(sum_scores(scores, id, mode, reverse), 2)) + "\t" + "\t".join([str(round(scores[id][mode][event], 2)) for event in header]))
+    for rank, i in enumerate(ranking):
+        prefix = str(rank + 1) + " "*(len(str(l)) - len(str(rank + 1)) + 1) + name(i) + " "*(max_len - len(name(i))) + "\t"
+        print(prefix + str(round(totals[i], 2)) + "\t" + "\t".join([str(round(scores[mode][i][j], 2)) for j in columns]))
+
+def sor_ranks(ranks, mode: str="Single") -> np.ndarray:
+    """ Returns the place in the world of each SoR, 0 if it would be last. """
+    init()
+    # people with a total SoR of at least rank
+    i = np.searchsorted(sor_totals[mode], ranks, side="left")
+    return np.where(i < len(sor_totals[mode]), i + 1, 0)
+
+def kinch_ranks(kinch_scores) -> np.ndarray:
+    """ Returns the place in the world of each Kinch score, 0 if it would be last. """
+    init()
+    # people with a strictly larger Kinch score
+    i = len(kinch_totals) - np.searchsorted(kinch_totals, kinch_scores, side="right")
+    return np.where(i < len(kinch_totals), i + 1, 0)
 
 def sor_rank(rank: int, mode: str="Single") -> int:
     """ Returns the place in the world that rank would be. """
-    ranking = sorted(list(persons), key=lambda x: sum_scores(sor_scores, x, mode))
-    for i in range(len(ranking)):
-        if rank <= sum_scores(sor_scores, ranking[i], mode):
-            return i + 1
+    return int(sor_ranks([rank], mode)[0]) or None
 
 def kinch_rank(kinch_score: float) -> int:
-    ranking = sorted(list(persons), key=lambda x: sum_scores(kinch_scores, x, "Average"), reverse=True)
-    for i in range(len(ranking)):
-        if kinch_score >= sum_scores(kinch_scores, ranking[i], "Average", True):
-            return i + 1
+    return int(kinch_ranks([kinch_score])[0]) or None
 
-events = [x[0] for x in sorted(parse("Events"), key=lambda x: int(x[1]))[:-3]]
-persons = {p[0]: p[1] for p in parse("Persons")}
+def ranks(sing: int, avg: int, kinch_score: float) -> tuple:
+    """ Returns the places in the world of an SoR single, SoR average and Kinch score. """
+    return (sor_rank(sing, "Single"), sor_rank(avg, "Average")), kinch_rank(kinch_score)
+
+persons = np.zeros(0, dtype="S10")
 wrd, rankd = {"Single": {}, "Average": {}}, {"Single": {}, "Average": {}}
 
 modes = ["Single", "Average"]
 funcs = {"sor": sor, "kinch": kinch}
 
-sor_scores, kinch_scores = find_scores("sor"), find_scores("kinch")
-
-with open("files/wca/cache.json", "w") as f:
-    json.dump({"wrs": wrd, "ranks": rankd}, f, indent=4, sort_keys=True)
+# the index is mapped lazily, on the first query of each process, and identified by when meta.json was written
+loaded, lock = None, threading.Lock()
 
 if __name__ == "__main__":
-    print(sor_rank(int(sys.argv[1]), "Single"),
-          sor_rank(int(sys.argv[2]), "Average"),
-          kinch_rank(float(sys.argv[3])))
+    parser = argparse.ArgumentParser(description="Ingests the WCA export and queries the index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("ingest", help="bring the index up to date with the export")
+    build.add_argument("--full", action="store_true", help="rebuild even if the index is up to date")
+    query = commands.add_parser("ranks", help="places in the world of an SoR single, SoR average and Kinch score")
+    query.add_argument("sing", type=int)
+    query.add_argument("avg", type=int)
+    query.add_argument("kinch", type=float)
+    args = parser.parse_args()
 
+    if args.command == "ingest":
+        print("ingested" if refresh(args.full) else "already up to date")
+    else:
+        (sing, avg), kinch_score = ranks(args.sing, args.avg, args.kinch)
+        print(sing, avg, kinch_score)
+
+    # init()
     # display("sor", sor_scores, "Single", False, 30)
     # display("kinch", kinch_scores, "Average", True, 30)
 
     # print(sor_rank(3805, "Single"))
     # print(sor_rank(1483, "Average"))
     # print(kinch_rank(59.57))
-